@@ -0,0 +1,348 @@
+import os
+import sqlite3
+import time
+import unicodedata
+
+DATABASE_PATH = "imageTagger.db"
+# Bumped whenever create_tables has to migrate existing data, stored in PRAGMA user_version
+SCHEMA_VERSION = 8
+# Writes are committed once this many rows are pending, or this many seconds after the first one
+COMMIT_ROWS = 200
+COMMIT_INTERVAL = 2.0
+# Seconds a connection waits for another one to finish writing
+BUSY_TIMEOUT = 30
+
+# Columns added to images after the first release, added in place to existing databases
+IMAGE_COLUMNS = {
+    "fileSize": "INTEGER",
+    "mtime": "INTEGER",
+    "inode": "INTEGER",
+    # Sort keys, so the GUI never has to stat or open a file to sort
+    "ctime": "INTEGER",
+    "width": "INTEGER",
+    "height": "INTEGER",
+    "sortName": "VARCHAR(2000)",
+    # Set when the file is deleted. The row keeps its id, favorite flag and results in case the
+    # file shows up again, e.g. moved back into a watched folder.
+    "deleted": "INTEGER NOT NULL DEFAULT 0",
+}
+
+# Columns added to tags after it was introduced
+TAG_COLUMNS = {
+    "imageCount": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+def connect(**kwargs):
+    conn = sqlite3.connect(DATABASE_PATH, timeout=BUSY_TIMEOUT, **kwargs)
+    # WAL lets the GUI keep reading while a scan writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def create_tables(conn):
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            directory VARCHAR(3000),
+            deleteMetadata BOOLEAN,
+            writeMetadata BOOLEAN,
+            autoScan BOOLEAN
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shaValue CHAR(64),
+            path VARCHAR(2000),
+            filename VARCHAR(2000),
+            tags VARCHAR(2000),
+            text VARCHAR(3000),
+            desc VARCHAR(4000),
+            favorites BOOLEAN
+        )
+    ''')
+
+    add_missing_columns(cursor, "images", IMAGE_COLUMNS)
+
+    # Tag dictionary and per-image tag scores. The primary key answers "images with tag X" and the
+    # second index "tags of image Y", both without touching the table.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY,
+            name VARCHAR(200) NOT NULL UNIQUE
+        )
+    ''')
+    add_missing_columns(cursor, "tags", TAG_COLUMNS)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_tags (
+            tag_id INTEGER NOT NULL,
+            image_id INTEGER NOT NULL,
+            score REAL,
+            PRIMARY KEY (tag_id, image_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS image_tags_image ON image_tags (image_id, tag_id, score)")
+
+    # Number of images per tag, deleted images not included. Kept current by every write to
+    # image_tags and every change of images.deleted. Indexed for the tag picker, which lists tags by
+    # frequency.
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS tag_count_insert AFTER INSERT ON image_tags
+        WHEN (SELECT deleted FROM images WHERE id = new.image_id) = 0 BEGIN
+            UPDATE tags SET imageCount = imageCount + 1 WHERE id = new.tag_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS tag_count_delete AFTER DELETE ON image_tags
+        WHEN (SELECT deleted FROM images WHERE id = old.image_id) = 0 BEGIN
+            UPDATE tags SET imageCount = imageCount - 1 WHERE id = old.tag_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS tag_count_deleted_image AFTER UPDATE OF deleted ON images
+        WHEN new.deleted != old.deleted BEGIN
+            UPDATE tags SET imageCount = imageCount + (CASE WHEN new.deleted THEN -1 ELSE 1 END)
+            WHERE id IN (SELECT tag_id FROM image_tags WHERE image_id = new.id);
+        END
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS tags_count ON tags (imageCount DESC, name)")
+
+    # Where the thumbnail of each image content is stored in the thumbnail pack
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            shaValue CHAR(64) PRIMARY KEY,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+    # Modification time of every fully scanned directory, a directory whose mtime hasn't changed has
+    # the same files as at the last scan
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS directories (
+            path VARCHAR(2000) PRIMARY KEY,
+            mtime INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version < 2:
+        remove_duplicate_images(cursor)
+    if version < 3:
+        split_image_tags(cursor)
+    if version < 5:
+        # ctime and the dimensions are filled in by the next scan
+        rows = cursor.execute("SELECT id, filename FROM images").fetchall()
+        cursor.executemany("UPDATE images SET sortName = ? WHERE id = ?", [(sort_name(filename), imageId) for imageId, filename in rows])
+    if version < 6:
+        cursor.execute("UPDATE tags SET imageCount = (SELECT COUNT(*) FROM image_tags WHERE tag_id = tags.id)")
+    if version < 7:
+        # Replaced by the tag_count triggers, which leave deleted images out
+        cursor.execute("DROP TRIGGER IF EXISTS image_tags_count_insert")
+        cursor.execute("DROP TRIGGER IF EXISTS image_tags_count_delete")
+    if version < 8:
+        normalize_paths(cursor)
+
+    # Full-text index over the OCR text. It stores no copy of the text (content='images'), the
+    # triggers keep it in step with every write to images. Created after the migrations, which
+    # delete rows it never indexed.
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS images_text USING fts5 (text, content='images', content_rowid='id')")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS images_text_insert AFTER INSERT ON images BEGIN
+            INSERT INTO images_text (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS images_text_delete AFTER DELETE ON images BEGIN
+            INSERT INTO images_text (images_text, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS images_text_update AFTER UPDATE OF text ON images BEGIN
+            INSERT INTO images_text (images_text, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO images_text (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+
+    if version < 4:
+        # Index the text of rows written before the full-text table existed
+        cursor.execute("INSERT INTO images_text (images_text) VALUES ('rebuild')")
+
+    # Images are looked up by location when scanning and by content when checking for copies
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_location ON images (path, filename)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS images_sha ON images (shaValue)")
+
+    if version < SCHEMA_VERSION:
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+
+def add_missing_columns(cursor, table, columns):
+    existingColumns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    for column, columnType in columns.items():
+        if column not in existingColumns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {columnType}")
+
+
+def remove_duplicate_images(cursor):
+    # Older scanners could insert the same file more than once, keep the newest row and its favorite flag
+    cursor.execute('''
+        UPDATE images SET favorites = TRUE WHERE id IN (
+            SELECT MAX(id) FROM images GROUP BY path, filename HAVING MAX(favorites) = TRUE
+        )
+    ''')
+    cursor.execute("DELETE FROM images WHERE id NOT IN (SELECT MAX(id) FROM images GROUP BY path, filename)")
+    cursor.execute("DELETE FROM image_tags WHERE image_id NOT IN (SELECT id FROM images)")
+
+
+def normalize_paths(cursor):
+    # Paths used to be stored as the scan spelled them, e.g. "C:/photos/2020" when added on its own and
+    # "C:/photos\2020" when scanned from "C:/photos". Rows that turn out to be the same file are merged.
+    rows = cursor.execute("SELECT id, path FROM images").fetchall()
+    changed = [(os.path.normpath(path), imageId) for imageId, path in rows if path is not None and os.path.normpath(path) != path]
+    if not changed:
+        return
+    # Recreated once the duplicates are gone
+    cursor.execute("DROP INDEX IF EXISTS images_location")
+    cursor.executemany("UPDATE images SET path = ? WHERE id = ?", changed)
+    remove_duplicate_images(cursor)
+    cursor.execute('''
+        UPDATE tags SET imageCount = (
+            SELECT COUNT(*) FROM image_tags JOIN images ON images.id = image_tags.image_id
+            WHERE image_tags.tag_id = tags.id AND images.deleted = 0
+        )
+    ''')
+
+
+def split_image_tags(cursor):
+    # Fills image_tags from the ";"-joined tags strings of databases scanned before it existed, scores are unknown
+    tagIds = {}
+    rows = cursor.execute("SELECT id, tags FROM images WHERE tags IS NOT NULL").fetchall()
+    for imageId, tags in rows:
+        for name in tags.split(";"):
+            if not name:
+                continue
+            if name not in tagIds:
+                tagIds[name] = get_tag_id(cursor, name)
+            cursor.execute("INSERT OR IGNORE INTO image_tags (tag_id, image_id) VALUES (?, ?)", (tagIds[name], imageId))
+
+
+def sort_name(filename):
+    # Case and width insensitive name order
+    return unicodedata.normalize("NFKC", filename).casefold()
+
+
+def get_tag_id(cursor, name):
+    cursor.execute("INSERT INTO tags (name) VALUES (?) ON CONFLICT (name) DO NOTHING", (name,))
+    return cursor.execute("SELECT id FROM tags WHERE name = ?", (name,)).fetchone()[0]
+
+
+def move_image(cursor, oldPath, oldName, newPath, newName):
+    # Points the row of a moved file at its new location, replacing a row already there. Returns
+    # False when neither location has a row, e.g. for a file that was never scanned.
+    row = cursor.execute("SELECT id FROM images WHERE path = ? AND filename = ?", (oldPath, oldName)).fetchone()
+    if row is None:
+        # Possibly moved already, together with its directory
+        return cursor.execute("SELECT 1 FROM images WHERE path = ? AND filename = ? AND deleted = 0", (newPath, newName)).fetchone() is not None
+    remove_image(cursor, newPath, newName)
+    cursor.execute("UPDATE images SET path = ?, filename = ?, sortName = ?, deleted = 0 WHERE id = ?", (newPath, newName, sort_name(newName), row[0]))
+    return True
+
+
+def move_directory(cursor, oldPath, newPath):
+    # Moves the rows of every file below oldPath, at any depth, in one statement per table. Rows
+    # already below newPath are left of files that were there before.
+    if cursor.execute(f"SELECT 1 FROM images WHERE {under_directory('path')} LIMIT 1", (oldPath, *directory_prefix(oldPath))).fetchone() is None:
+        # Nothing scanned there, or moved already together with its parent
+        return
+    for row in cursor.execute(f"SELECT id FROM images WHERE {under_directory('path')}", (newPath, *directory_prefix(newPath))).fetchall():
+        remove_image_id(cursor, row[0])
+    for table in ("images", "directories"):
+        cursor.execute(
+            f"UPDATE {table} SET path = ? || substr(path, ?) WHERE {under_directory('path')}",
+            (newPath, len(oldPath) + 1, oldPath, *directory_prefix(oldPath)),
+        )
+
+
+def mark_deleted(cursor, path, filename):
+    cursor.execute("UPDATE images SET deleted = 1 WHERE path = ? AND filename = ?", (path, filename))
+
+
+def mark_directory_deleted(cursor, path):
+    cursor.execute(f"UPDATE images SET deleted = 1 WHERE {under_directory('path')}", (path, *directory_prefix(path)))
+    cursor.execute(f"DELETE FROM directories WHERE {under_directory('path')}", (path, *directory_prefix(path)))
+
+
+def remove_image(cursor, path, filename):
+    row = cursor.execute("SELECT id FROM images WHERE path = ? AND filename = ?", (path, filename)).fetchone()
+    if row is not None:
+        remove_image_id(cursor, row[0])
+
+
+def remove_image_id(cursor, imageId):
+    # Tags first, the tag counts only see tags of images that still exist
+    cursor.execute("DELETE FROM image_tags WHERE image_id = ?", (imageId,))
+    cursor.execute("DELETE FROM images WHERE id = ?", (imageId,))
+
+
+def under_directory(column):
+    # Matches the directory itself and everything below it, takes the directory and directory_prefix
+    # as parameters. Compares prefixes instead of using LIKE, whose wildcards can appear in paths.
+    return f"({column} = ? OR substr({column}, 1, ?) = ?)"
+
+
+def directory_prefix(path):
+    prefix = os.path.join(path, "")
+    return len(prefix), prefix
+
+
+def text_match_query(text):
+    # Turns search box input into an FTS5 query: every word has to appear, as a whole word or a prefix
+    words = text.split()
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+def drop_image_tables(cursor):
+    # Removes every scan result, the settings and the thumbnails, which are keyed by content, are kept
+    cursor.execute("DROP TABLE IF EXISTS images_text")
+    cursor.execute("DROP TABLE IF EXISTS image_tags")
+    cursor.execute("DROP TABLE IF EXISTS tags")
+    cursor.execute("DROP TABLE IF EXISTS images")
+    cursor.execute("DROP TABLE IF EXISTS directories")
+
+
+class BatchedWriter:
+    # Groups writes into one transaction per COMMIT_ROWS rows or COMMIT_INTERVAL seconds
+    def __init__(self, conn, rows=COMMIT_ROWS, interval=COMMIT_INTERVAL):
+        self.conn = conn
+        self.rows = rows
+        self.interval = interval
+        self.pending = 0
+        self.firstWrite = 0.0
+
+    def execute(self, query, params=()):
+        cursor = self.conn.execute(query, params)
+        self.count_write()
+        return cursor
+
+    def executemany(self, query, rows):
+        # Counts as a single write
+        cursor = self.conn.executemany(query, rows)
+        self.count_write()
+        return cursor
+
+    def count_write(self):
+        if self.pending == 0:
+            self.firstWrite = time.monotonic()
+        self.pending += 1
+        if self.pending >= self.rows or time.monotonic() - self.firstWrite >= self.interval:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
@@ -1,45 +1,129 @@
+import atexit
+import threading
 import exiftool
+from exiftool.exceptions import ExifToolExecuteError
+
+# Files rewritten in one exiftool round trip by update_metadata_batch
+WRITE_BATCH_SIZE = 16
+# Printed after every command of a batch with its exit status
+STATUS_PREFIX = "status="
+
+
+class ExifSession:
+    # One exiftool process kept open in -stay_open mode and shared by every caller,
+    # started on first use so ExifTool is only needed when metadata options are used
+    def __init__(self):
+        self.helper = None
+        self.lock = threading.Lock()
+
+    def get_helper(self):
+        if self.helper is None:
+            self.helper = exiftool.ExifToolHelper()
+        return self.helper
+
+    def execute(self, *params):
+        with self.lock:
+            return self.get_helper().execute(*params)
+
+    def execute_batch(self, commands):
+        # Runs several commands in one round trip, chained with -execute. Returns the exit status of
+        # each command in order.
+        params = []
+        for command in commands:
+            params.extend((*command, "-echo3", STATUS_PREFIX + "${status}", "-execute"))
+        with self.lock:
+            try:
+                # The last -execute is added by execute()
+                output = self.get_helper().execute(*params[:-1])
+            except ExifToolExecuteError as e:
+                # Only the status of the last command is checked
+                output = e.stdout
+        statuses = [int(line[len(STATUS_PREFIX):]) for line in output.splitlines() if line.startswith(STATUS_PREFIX)]
+        if len(statuses) != len(commands):
+            raise RuntimeError(f"exiftool returned {len(statuses)} results for {len(commands)} commands")
+        return statuses
+
+    def get_metadata(self, image):
+        with self.lock:
+            return self.get_helper().get_metadata(image)
+
+    def terminate(self):
+        with self.lock:
+            if self.helper is not None and self.helper.running:
+                self.helper.terminate()
+
+
+session = ExifSession()
+atexit.register(session.terminate)
+
+
+def metadata_arguments(delete=False, tags=None, text=None):
+    # "-all=" is applied before the new values, so everything fits in a single rewrite
+    arguments = []
+    if delete:
+        arguments.append("-all=")
+    if tags is not None:
+        arguments.append(f"-XMP-dc:Subject={tags}")
+    if text is not None:
+        arguments.append(f"-XMP-dc:Description={text}")
+    return arguments
+
+
+def update_metadata(image, delete=False, tags=None, text=None):
+    arguments = metadata_arguments(delete, tags, text)
+    if arguments:
+        session.execute(*arguments, "-overwrite_original", image)
+
+
+def update_metadata_batch(updates):
+    # updates are (image, delete, tags, text), rewritten WRITE_BATCH_SIZE files per round trip.
+    # Returns the error of each update, None for the ones that succeeded.
+    errors = [None] * len(updates)
+    commands = []
+    for index, (image, delete, tags, text) in enumerate(updates):
+        arguments = metadata_arguments(delete, tags, text)
+        if arguments:
+            commands.append((index, [*arguments, "-overwrite_original", image]))
+
+    for start in range(0, len(commands), WRITE_BATCH_SIZE):
+        batch = commands[start:start + WRITE_BATCH_SIZE]
+        statuses = session.execute_batch([command for _, command in batch])
+        for (index, command), status in zip(batch, statuses):
+            if status != 0:
+                errors[index] = ExifToolExecuteError(status, "", "", command)
+    return errors
 
 
 def get_metadata(image):
-    with exiftool.ExifToolHelper() as et:
-        metadata = et.get_metadata(image)
-    return metadata
+    return session.get_metadata(image)
 
 
 def delete_metadata(image):
-    with exiftool.ExifToolHelper() as et:
-        et.execute("-all=", "-overwrite_original", image)
+    update_metadata(image, delete=True)
 
 
 def write_tags(image, tags):
-    with exiftool.ExifToolHelper() as et:
-        et.execute(f"-XMP-dc:Subject={tags}", "-overwrite_original", image)
+    update_metadata(image, tags=tags)
 
 
 def write_text(image, text):
-    with exiftool.ExifToolHelper() as et:
-        et.execute(f"-XMP-dc:Description={text}", "-overwrite_original", image)
+    update_metadata(image, text=text)
 
 
 def write_comment(image, comment):
-    with exiftool.ExifToolHelper() as et:
-        et.execute(f"-XMP-exif:UserComment={comment}", "-overwrite_original", image)
+    session.execute(f"-XMP-exif:UserComment={comment}", "-overwrite_original", image)
 
 
 def read_tags(image):
-    with exiftool.ExifToolHelper() as et:
-        tags = et.execute("-XMP-dc:Subject", image)
+    tags = session.execute("-XMP-dc:Subject", image)
     return tags.split(":")[1].strip()
 
 
 def read_text(image):
-    with exiftool.ExifToolHelper() as et:
-        text = et.execute("-XMP-dc:Description", image)
+    text = session.execute("-XMP-dc:Description", image)
     return text.split(":")[1].strip()
 
 
 def read_comment(image):
-    with exiftool.ExifToolHelper() as et:
-        comment = et.execute("-XMP-exif:UserComment", image)
+    comment = session.execute("-XMP-exif:UserComment", image)
     return comment.split(":")[1].strip()
@@ -0,0 +1,117 @@
+import threading
+import numpy as np
+
+EMPTY = np.empty(0, dtype=np.int64)
+# Images re-read per query by update_images, below SQLite's limit on query parameters
+UPDATE_CHUNK = 500
+
+
+class FilterIndex:
+    # Tag and favorite filters held in memory. Every image gets a dense position, each tag keeps the
+    # sorted positions of its images, so a filter is a few array intersections instead of a query.
+    # Rewritten images get a new position at the end and the old one is marked dead, which keeps the
+    # tag arrays sorted without rebuilding them. The GUI updates it while the search worker reads it.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.ids = EMPTY
+        self.alive = np.empty(0, dtype=bool)
+        self.favorites = np.empty(0, dtype=bool)
+        self.positions = {}
+        self.tagPositions = {}
+
+    def load(self, cursor):
+        with self.lock:
+            rows = cursor.execute("SELECT id, favorites FROM images WHERE deleted = 0 ORDER BY id").fetchall()
+            self.ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            self.favorites = np.fromiter((bool(row[1]) for row in rows), dtype=bool, count=len(rows))
+            self.alive = np.ones(len(rows), dtype=bool)
+            self.positions = {imageId: position for position, imageId in enumerate(self.ids.tolist())}
+
+            # Grouped by tag, image ids ascending within a tag, which is the primary key order
+            pairs = np.array(cursor.execute("SELECT tag_id, image_id FROM image_tags ORDER BY tag_id, image_id").fetchall(), dtype=np.int64).reshape(-1, 2)
+            tagNames = dict(cursor.execute("SELECT id, name FROM tags").fetchall())
+            self.tagPositions = {}
+            if len(pairs) and len(self.ids):
+                positions = np.searchsorted(self.ids, pairs[:, 1]).clip(max=len(self.ids) - 1)
+                known = self.ids[positions] == pairs[:, 1]
+                tagIds, positions = pairs[known, 0], positions[known]
+                starts = np.flatnonzero(np.r_[True, tagIds[1:] != tagIds[:-1]])
+                for tagId, tagPositions in zip(tagIds[starts].tolist(), np.split(positions, starts[1:])):
+                    self.tagPositions[tagNames[tagId]] = tagPositions
+
+    def update_images(self, cursor, imageIds):
+        # Re-reads the given images, new ones are added, changed ones replace their old position and
+        # deleted ones are removed
+        with self.lock:
+            imageIds = sorted(imageIds)
+            self.remove_images(imageIds)
+            for start in range(0, len(imageIds), UPDATE_CHUNK):
+                self.add_images(cursor, imageIds[start:start + UPDATE_CHUNK])
+
+    def add_images(self, cursor, imageIds):
+        # Called with the lock held
+        placeholders = ",".join("?" * len(imageIds))
+        rows = cursor.execute(f"SELECT id, favorites FROM images WHERE id IN ({placeholders}) AND deleted = 0 ORDER BY id", imageIds).fetchall()
+        if not rows:
+            return
+
+        start = len(self.ids)
+        self.ids = np.concatenate([self.ids, [row[0] for row in rows]])
+        self.favorites = np.concatenate([self.favorites, [bool(row[1]) for row in rows]])
+        self.alive = np.concatenate([self.alive, np.ones(len(rows), dtype=bool)])
+        for position, (imageId, _) in enumerate(rows, start):
+            self.positions[imageId] = position
+
+        added = {}
+        liveIds = [row[0] for row in rows]
+        tagQuery = f'''
+            SELECT tags.name, image_tags.image_id FROM image_tags JOIN tags ON tags.id = image_tags.tag_id
+            WHERE image_tags.image_id IN ({",".join("?" * len(liveIds))})
+        '''
+        for name, imageId in cursor.execute(tagQuery, liveIds):
+            added.setdefault(name, []).append(self.positions[imageId])
+        for name, positions in added.items():
+            # The new positions are past every existing one, so appending keeps the array sorted
+            self.tagPositions[name] = np.concatenate([self.tagPositions.get(name, EMPTY), np.sort(positions)])
+
+    def remove_images(self, imageIds):
+        with self.lock:
+            for imageId in imageIds:
+                position = self.positions.pop(imageId, None)
+                if position is not None:
+                    self.alive[position] = False
+
+    def set_favorite(self, imageId, favorite):
+        with self.lock:
+            position = self.positions.get(imageId)
+            if position is not None:
+                self.favorites[position] = favorite
+
+    def filter(self, tags=(), favorites=False, ids=None):
+        # Returns the ids of the images having every tag, optionally only favorites. ids limits the
+        # result to those images and keeps their order, e.g. ranked text search results.
+        with self.lock:
+            mask = self.alive & self.favorites if favorites else self.alive
+            if tags:
+                tagArrays = []
+                for tag in tags:
+                    positions = self.tagPositions.get(tag)
+                    if positions is None:
+                        return EMPTY
+                    tagArrays.append(positions)
+                # Start from the rarest tag so every intersection is as small as possible
+                tagArrays.sort(key=len)
+                positions = tagArrays[0]
+                for tagPositions in tagArrays[1:]:
+                    positions = np.intersect1d(positions, tagPositions, assume_unique=True)
+                positions = positions[mask[positions]]
+            else:
+                positions = np.flatnonzero(mask)
+
+            if ids is not None:
+                selected = np.zeros(len(self.ids), dtype=bool)
+                selected[positions] = True
+                positions = np.fromiter((self.positions.get(imageId, -1) for imageId in ids), dtype=np.int64)
+                positions = positions[positions >= 0]
+                positions = positions[selected[positions]]
+            return self.ids[positions]
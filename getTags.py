@@ -1,3 +1,4 @@
+import threading
 import numpy as np
 import onnxruntime as onr
 import pandas as pd
@@ -6,21 +7,26 @@ from downloadModel import check_and_download
 
 LABEL_FILE_PATH = "tagsModel/selected_tags.csv"
 MODEL_FILE_PATH = "tagsModel/model.onnx"
+# Per-image decode budget, larger images are rejected before their pixels are read
+MAX_DECODE_PIXELS = 64_000_000
+# ONNX Runtime threads per session, 0 lets it use every core
+INTRA_OP_THREADS = 0
 
 
-def load_labels(dataframe) -> list[str]:
+def load_labels(dataframe) -> tuple[list[str], np.ndarray, np.ndarray, np.ndarray]:
     name_series = dataframe["name"]
     tag_names = name_series.tolist()
 
-    rating_indexes = list(np.where(dataframe["category"] == 9)[0])
-    general_indexes = list(np.where(dataframe["category"] == 0)[0])
-    character_indexes = list(np.where(dataframe["category"] == 4)[0])
+    rating_indexes = np.flatnonzero(dataframe["category"] == 9)
+    general_indexes = np.flatnonzero(dataframe["category"] == 0)
+    character_indexes = np.flatnonzero(dataframe["category"] == 4)
     return tag_names, rating_indexes, general_indexes, character_indexes
 
 
 class Predictor:
-    def __init__(self):
+    def __init__(self, intra_op_threads=INTRA_OP_THREADS):
         self.model_target_size = None
+        self.intra_op_threads = intra_op_threads
         self.load_model(MODEL_FILE_PATH, LABEL_FILE_PATH)
 
     def load_model(self, model_path, csv_path):
@@ -33,95 +39,165 @@ class Predictor:
         self.rating_indexes = sep_tags[1]
         self.general_indexes = sep_tags[2]
         self.character_indexes = sep_tags[3]
-
-        model = onr.InferenceSession(model_path)
+        # General and character tags share the same threshold
+        self.tag_indexes = np.concatenate([self.general_indexes, self.character_indexes])
+
+        # Label written for each tag id, ratings are stored as "rating:<name>"
+        labels = np.array(self.tag_names, dtype=object)
+        for i in self.rating_indexes:
+            labels[i] = "rating:safe" if self.tag_names[i] == "general" else "rating:" + self.tag_names[i]
+        self.labels = labels
+
+        options = onr.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        model = onr.InferenceSession(model_path, options)
         _, height, width, _ = model.get_inputs()[0].shape
         self.model_target_size = height
 
         self.model = model
 
-    def prepare_image(self, image):
+    def allocate_batch(self, batch_size):
+        # Reusable input tensor, filled slot by slot with prepare_image
         target_size = self.model_target_size
+        return np.empty((batch_size, target_size, target_size, 3), dtype=np.float32)
 
-        if image.mode != "RGBA":
-            image = image.convert("RGBA")
+    def resize_image(self, image):
+        # Fit the longest side to the model size, keep alpha so it can be flattened later
+        target_size = self.model_target_size
 
-        canvas = Image.new("RGBA", image.size, (255, 255, 255, 0))
-        canvas.alpha_composite(image)
+        mode = "RGBA" if has_alpha(image) else "RGB"
+        if image.mode != mode:
+            image = image.convert(mode)
 
-        image = canvas.convert("RGB")
+        width, height = image.size
+        scale = target_size / max(width, height)
+        new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if new_size != image.size:
+            image = image.resize(new_size, Image.BICUBIC)
+        return image
 
-        # Pad image to square
-        image_shape = image.size
-        max_dim = max(image_shape)
-        pad_left = (max_dim - image_shape[0]) // 2
-        pad_top = (max_dim - image_shape[1]) // 2
+    def prepare_image(self, image, out=None):
+        # Letterbox into out, a (H, W, 3) slot of a batch buffer. Safe to call from several
+        # threads as long as each one writes to its own slot.
+        target_size = self.model_target_size
+        if out is None:
+            batch = self.allocate_batch(1)
+            self.prepare_image(image, batch[0])
+            return batch
+
+        if max(image.size) != target_size or image.mode not in ("RGB", "RGBA"):
+            image = self.resize_image(image)
+
+        # Pad image to square with white
+        width, height = image.size
+        pad_left = (target_size - width) // 2
+        pad_top = (target_size - height) // 2
+        out[:pad_top] = 255
+        out[pad_top + height:] = 255
+        out[pad_top:pad_top + height, :pad_left] = 255
+        out[pad_top:pad_top + height, pad_left + width:] = 255
+
+        # Copy PIL-native RGB into the slot as BGR
+        pixels = np.asarray(image)
+        region = out[pad_top:pad_top + height, pad_left:pad_left + width]
+        region[...] = pixels[:, :, 2::-1]
+
+        # Fully transparent pixels become white, like the padding around them. The model used to get
+        # their stored RGB, often black, as compositing onto a transparent canvas left them unchanged.
+        if image.mode == "RGBA":
+            region[pixels[:, :, 3] == 0] = 255
+
+        return out
 
-        padded_image = Image.new("RGB", (max_dim, max_dim), (255, 255, 255))
-        padded_image.paste(image, (pad_left, pad_top))
+    def predict(self, image, general_thresh):
+        tag_ids, scores = self.predict_batch([image], general_thresh)[0]
+        return dict(zip(self.tag_labels(tag_ids), scores.astype(float)))
+
+    def predict_batch(self, images, general_thresh):
+        batch = self.allocate_batch(len(images))
+        for image, slot in zip(images, batch):
+            self.prepare_image(image, slot)
+        return self.predict_tensor(batch, general_thresh)
+
+    def predict_tensor(self, batch, general_thresh):
+        # batch is a contiguous (B, H, W, 3) float32 array and is passed to the session as is,
+        # the model has a dynamic batch dimension so the whole batch runs in one call
+        input_name = self.model.get_inputs()[0].name
+        label_name = self.model.get_outputs()[0].name
+        preds = self.model.run([label_name], {input_name: batch})[0]
 
-        # Resize
-        if max_dim != target_size:
-            padded_image = padded_image.resize(
-                (target_size, target_size),
-                Image.BICUBIC,
-            )
+        return self.process_predictions(preds, general_thresh)
 
-        # Convert to numpy array
-        image_array = np.asarray(padded_image, dtype=np.float32)
+    def process_predictions(self, preds, general_thresh):
+        # Returns (tag ids, scores) per image, sorted by score
+        batch_rows = np.arange(len(preds))
 
-        # Convert PIL-native RGB to BGR
-        image_array = image_array[:, :, ::-1]
+        # First 4 labels are actually ratings: pick one with argmax
+        rating_ids = self.rating_indexes[preds[:, self.rating_indexes].argmax(axis=1)]
 
-        return np.expand_dims(image_array, axis=0)
+        # General and character tags: pick any where prediction confidence > threshold
+        rows, cols = np.nonzero(preds[:, self.tag_indexes] > general_thresh)
 
-    def predict(self, image, general_thresh):
-        image = self.prepare_image(image)
+        rows = np.concatenate([rows, batch_rows])
+        tag_ids = np.concatenate([self.tag_indexes[cols], rating_ids])
+        scores = preds[rows, tag_ids]
 
-        input_name = self.model.get_inputs()[0].name
-        label_name = self.model.get_outputs()[0].name
-        preds = self.model.run([label_name], {input_name: image})[0]
+        # Group by image, highest score first
+        order = np.lexsort((-scores, rows))
+        splits = np.cumsum(np.bincount(rows, minlength=len(preds)))[:-1]
+        return list(zip(np.split(tag_ids[order], splits), np.split(scores[order], splits)))
 
-        labels = list(zip(self.tag_names, preds[0].astype(float)))
+    def tag_labels(self, tag_ids):
+        return self.labels[tag_ids].tolist()
 
-        # First 4 labels are actually ratings: pick one with argmax
-        ratings_names = [labels[i] for i in self.rating_indexes]
-        ratings_names = dict(ratings_names)
-        ratings_names = sorted(
-            ratings_names.items(),
-            key=lambda x: x[1],
-            reverse=True,
-        )
 
-        # Then we have general tags: pick any where prediction confidence > threshold
-        general_names = [labels[i] for i in self.general_indexes]
-        general_res = [x for x in general_names if x[1] > general_thresh]
-        general_res = dict(general_res)
-
-        # Character tags
-        character_names = [labels[i] for i in self.character_indexes]
-        character_res = [x for x in character_names if x[1] > general_thresh]
-        character_res = dict(character_res)
-        general_res.update(character_res)
-
-        ratings = "rating:" + ratings_names[0][0]
-        if ratings_names[0][0] == "general":
-            ratings = "rating:safe"
-        general_res[ratings] = ratings_names[0][1]
-
-        general_res = sorted(
-            general_res.items(),
-            key=lambda x: x[1],
-            reverse=True,
-        )
-        return dict(general_res)
+# The predictor is loaded on first use, once per process
+predictor = None
+predictor_lock = threading.Lock()
 
 
-# Initialize the predictor object
-predictor = Predictor()
+def load_predictor(intra_op_threads=INTRA_OP_THREADS):
+    global predictor
+    with predictor_lock:
+        if predictor is None:
+            predictor = Predictor(intra_op_threads)
+    return predictor
 
 
-def getTag(image_path: str, score_threshold: float):
+def get_predictor():
+    return predictor or load_predictor()
+
+
+def has_alpha(image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+
+
+def load_image(image_path: str, target_size: int, max_pixels: int = MAX_DECODE_PIXELS):
     image = Image.open(image_path)
+    full_size = image.size
+
+    # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding, never below the target size
+    image.draft("RGB", (target_size, target_size))
+
+    width, height = image.size
+    if width * height > max_pixels:
+        image.close()
+        raise Image.DecompressionBombError(
+            f"{image_path} decodes to {width * height} pixels, the limit is {max_pixels}"
+        )
+
+    image.load()
+    # image.size is the decoded size, keep the real one for callers that store it
+    image.info["full_size"] = full_size
+    return image
+
+
+def getTag(image_path: str, score_threshold: float):
+    predictor = get_predictor()
+    image = load_image(image_path, predictor.model_target_size)
     return predictor.predict(image, score_threshold)
 
+
+def getTagNames(tag_ids) -> list[str]:
+    return get_predictor().tag_labels(tag_ids)
+
@@ -1,22 +1,107 @@
 import logging
+import queue
+import threading
+import numpy as np
+from contextlib import contextmanager
 from paddleocr import PaddleOCR
 
 logging.getLogger("ppocr").setLevel(logging.ERROR)
 
+DET_MODEL_DIR = "textModel/en_PP-OCRv3_det_infer"
+REC_MODEL_DIR = "textModel/en_PP-OCRv4_rec_infer"
+CLS_MODEL_DIR = "textModel/ch_ppocr_mobile_v2.0_cls_infer"
+# Maximum number of OCR engines kept alive, one is borrowed per worker thread
+OCR_POOL_SIZE = 1
+# CPU threads per engine, None keeps the PaddleOCR default
+OCR_CPU_THREADS = None
+
+
+class OcrEngine:
+    def __init__(self, cpuThreads=OCR_CPU_THREADS):
+        options = {}
+        if cpuThreads:
+            options["cpu_threads"] = cpuThreads
+        self.ocr = PaddleOCR(
+            lang='en',
+            use_angle_cls=True,
+            det_model_dir=DET_MODEL_DIR,
+            rec_model_dir=REC_MODEL_DIR,
+            cls_model_dir=CLS_MODEL_DIR,
+            **options
+        )
+
+    def warm_up(self):
+        # Run a blank image through det/cls/rec so the first real image only pays for inference
+        self.ocr.ocr(np.full((64, 64, 3), 255, dtype=np.uint8))
+
+    def read_text(self, image):
+        result = self.ocr.ocr(image)
+
+        finaltext = ''
+        if isinstance(result[0], list):
+            for i in range(len(result[0])):
+                text = result[0][i][1][0]
+                finaltext += ' ' + text
+        return finaltext
+
+
+class OcrEnginePool:
+    def __init__(self, size=OCR_POOL_SIZE, cpuThreads=OCR_CPU_THREADS):
+        self.size = size
+        self.cpuThreads = cpuThreads
+        self.created = 0
+        self.idleEngines = queue.Queue()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idleEngines.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+
+        if create:
+            try:
+                engine = OcrEngine(self.cpuThreads)
+                engine.warm_up()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+            return engine
+        # All engines are busy, wait for one to be returned
+        return self.idleEngines.get()
+
+    def grow(self, size):
+        # Allows up to size engines, never fewer than another scan sharing the pool asked for
+        with self.lock:
+            self.size = max(self.size, size)
+
+    def release(self, engine):
+        self.idleEngines.put(engine)
+
+    @contextmanager
+    def engine(self):
+        engine = self.acquire()
+        try:
+            yield engine
+        finally:
+            self.release(engine)
+
+    def warm_up(self):
+        # Load the models ahead of the first image
+        with self.engine():
+            pass
+
+
+# Shared by the scanner and the folder watcher
+ocrPool = OcrEnginePool()
+
+
 def ocr_with_paddle(image):
-    ocr = PaddleOCR(
-        lang='en',
-        use_angle_cls=True,
-        det_model_dir="textModel/en_PP-OCRv3_det_infer",
-        rec_model_dir="textModel/en_PP-OCRv4_rec_infer",
-        cls_model_dir="textModel/ch_ppocr_mobile_v2.0_cls_infer"
-    )
-
-    result = ocr.ocr(image)
-
-    finaltext = ''
-    if isinstance(result[0], list):
-        for i in range(len(result[0])):
-            text = result[0][i][1][0]
-            finaltext += ' ' + text
-    return finaltext
+    with ocrPool.engine() as engine:
+        return engine.read_text(image)
@@ -0,0 +1,362 @@
+import os
+import numpy as np
+from collections import OrderedDict
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QPoint, QRect, QSize, QTimer, pyqtSignal
+from PyQt6.QtGui import QColor, QPixmap
+from PyQt6.QtWidgets import QListView, QStyledItemDelegate
+from database import sort_name
+from thumbnailCache import THUMBNAIL_SIZE
+from thumbnailLoader import ThumbnailLoader
+
+SPACING = 10
+PADDING = 5
+# Memory for loaded thumbnails, about 270 at full size per 64 MiB. It has to hold at least a
+# screenful or visible thumbnails keep evicting each other.
+PIXMAP_CACHE_BYTES = 64 * 1024 * 1024
+# Milliseconds after scrolling or filtering before requests for hidden images are cancelled
+CANCEL_DELAY = 50
+PLACEHOLDER_COLOR = "#2b2b2b"
+
+IdRole = Qt.ItemDataRole.UserRole
+PathRole = Qt.ItemDataRole.UserRole + 1
+ResolutionRole = Qt.ItemDataRole.UserRole + 2
+SizeRole = Qt.ItemDataRole.UserRole + 3
+
+# Sort options, in the order of the sort list
+SORT_NAME, SORT_NAME_DESC, SORT_SIZE, SORT_SIZE_DESC, SORT_NEWEST, SORT_OLDEST = range(6)
+
+
+def format_size(size):
+    units = ["B", "KB", "MB", "GB"]
+    unitIndex = 0
+
+    while size >= 1024 and unitIndex < len(units) - 1:
+        size /= 1024
+        unitIndex += 1
+    return f"{size:.2f} {units[unitIndex]}"
+
+
+def pixmap_bytes(pixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+class PixmapCache:
+    # Least recently used thumbnails, evicted past a byte budget. Counts hits and misses.
+    def __init__(self, budget=PIXMAP_CACHE_BYTES):
+        self.budget = budget
+        self.pixmaps = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, key):
+        pixmap = self.pixmaps.get(key)
+        if pixmap is None:
+            self.misses += 1
+            return None
+        self.pixmaps.move_to_end(key)
+        self.hits += 1
+        return pixmap
+
+    def __contains__(self, key):
+        # Doesn't count as a lookup or refresh the entry
+        return key in self.pixmaps
+
+    def insert(self, key, pixmap):
+        old = self.pixmaps.pop(key, None)
+        if old is not None:
+            self.bytes -= pixmap_bytes(old)
+        self.pixmaps[key] = pixmap
+        self.bytes += pixmap_bytes(pixmap)
+        while self.bytes > self.budget and len(self.pixmaps) > 1:
+            _, evicted = self.pixmaps.popitem(last=False)
+            self.bytes -= pixmap_bytes(evicted)
+
+    def clear(self):
+        self.pixmaps.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "thumbnails": len(self.pixmaps),
+            "bytes": self.bytes,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ImageListModel(QAbstractListModel):
+    # Every image in the database, of which the rows in self.rows are shown in that order. Row
+    # numbers index self.ids, which is sorted so search results map to rows with one searchsorted.
+    def __init__(self, cacheBytes=PIXMAP_CACHE_BYTES):
+        super().__init__()
+        self.ids = np.empty(0, dtype=np.int64)
+        self.paths = []
+        self.filenames = []
+        # (offset, length) in the thumbnail pack, None for images scanned before it existed
+        self.thumbnailSpans = []
+        self.pixmaps = PixmapCache(cacheBytes)
+        self.thumbnailLoader = ThumbnailLoader(parent=self)
+        self.thumbnailLoader.loaded.connect(self.thumbnail_loaded)
+        self.rows = np.empty(0, dtype=np.int64)
+        # Position of every row in self.rows, -1 for hidden ones
+        self.viewRows = np.empty(0, dtype=np.int64)
+        # Sort keys and details stored by the scanner, 0 where a row predates them
+        self.sizes = np.empty(0, dtype=np.int64)
+        self.ctimes = np.empty(0, dtype=np.int64)
+        self.widths = np.empty(0, dtype=np.int64)
+        self.heights = np.empty(0, dtype=np.int64)
+        self.sortNames = []
+        # Resolutions read while loading thumbnails of rows without stored dimensions
+        self.resolutions = {}
+        # Ascending order of the rows per sort key, computed on first use
+        self.orders = {}
+        self.sortOption = SORT_NAME
+        self.sortRank = np.empty(0, dtype=np.int64)
+        self.visibleIds = None
+        self.ranked = False
+
+    def set_images(self, images):
+        # images: (id, path, filename, thumbnail offset, thumbnail length, fileSize, ctime, width, height,
+        # sortName) rows ordered by id
+        self.beginResetModel()
+        count = len(images)
+        self.ids = np.fromiter((image[0] for image in images), dtype=np.int64, count=count)
+        self.paths = [os.path.normpath(os.path.join(image[1], image[2])) for image in images]
+        self.filenames = [image[2] for image in images]
+        self.thumbnailSpans = [(image[3], image[4]) if image[3] is not None else None for image in images]
+        self.sizes = np.fromiter((image[5] or 0 for image in images), dtype=np.int64, count=count)
+        self.ctimes = np.fromiter((image[6] or 0 for image in images), dtype=np.int64, count=count)
+        self.widths = np.fromiter((image[7] or 0 for image in images), dtype=np.int64, count=count)
+        self.heights = np.fromiter((image[8] or 0 for image in images), dtype=np.int64, count=count)
+        self.sortNames = [image[9] if image[9] is not None else sort_name(image[2]) for image in images]
+        self.resolutions = {}
+        self.orders = {}
+        self.sortRank = self.sort_rank(self.sortOption)
+        self.update_rows()
+        self.endResetModel()
+
+    def set_visible(self, ids, ranked):
+        # Shows only ids, in their own order when ranked, otherwise in the sort order
+        self.beginResetModel()
+        self.visibleIds = ids
+        self.ranked = ranked
+        self.update_rows()
+        self.endResetModel()
+
+    def sort_images(self, option):
+        self.beginResetModel()
+        self.sortOption = option
+        self.sortRank = self.sort_rank(option)
+        self.ranked = False
+        self.update_rows()
+        self.endResetModel()
+
+    def sort_rank(self, option):
+        # Position of every row in the given sort order, from the stored keys only
+        if option in (SORT_NAME, SORT_NAME_DESC):
+            order = self.order("name", lambda: sorted(range(len(self.sortNames)), key=self.sortNames.__getitem__))
+        elif option in (SORT_SIZE, SORT_SIZE_DESC):
+            order = self.order("size", lambda: np.argsort(self.sizes, kind="stable"))
+        else:
+            order = self.order("ctime", lambda: np.argsort(self.ctimes, kind="stable"))
+        if option in (SORT_NAME_DESC, SORT_SIZE_DESC, SORT_NEWEST):
+            order = order[::-1]
+
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return rank
+
+    def order(self, key, compute):
+        order = self.orders.get(key)
+        if order is None:
+            order = self.orders[key] = np.asarray(compute(), dtype=np.int64)
+        return order
+
+    def update_rows(self):
+        if self.visibleIds is None:
+            self.rows = np.argsort(self.sortRank)
+        else:
+            ids = np.asarray(self.visibleIds, dtype=np.int64)
+            rows = np.searchsorted(self.ids, ids).clip(max=max(len(self.ids) - 1, 0))
+            rows = rows[self.ids[rows] == ids] if len(self.ids) else rows[:0]
+            if not self.ranked:
+                rows = rows[np.argsort(self.sortRank[rows], kind="stable")]
+            self.rows = rows
+
+        self.viewRows = np.full(len(self.ids), -1, dtype=np.int64)
+        self.viewRows[self.rows] = np.arange(len(self.rows))
+
+    def image_count(self):
+        return len(self.ids)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = int(self.rows[index.row()])
+
+        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.ToolTipRole):
+            return self.filenames[row]
+        if role == Qt.ItemDataRole.DecorationRole:
+            return self.thumbnail(row)
+        if role == IdRole:
+            return int(self.ids[row])
+        if role == PathRole:
+            return self.paths[row]
+        if role == ResolutionRole:
+            if self.widths[row]:
+                return f"{self.widths[row]} x {self.heights[row]}"
+            resolution = self.resolutions.get(row)
+            return f"{resolution.width()} x {resolution.height()}" if resolution else ""
+        if role == SizeRole:
+            # Unknown (0) for rows scanned before the size was stored, until the next scan
+            return format_size(int(self.sizes[row])) if self.sizes[row] else ""
+        return None
+
+    def thumbnail(self, row):
+        # Only called for rows being painted. Returns None until the thumbnail has been loaded.
+        pixmap = self.pixmaps.find(self.paths[row])
+        if pixmap is None:
+            self.thumbnailLoader.request(row, self.paths[row], self.thumbnailSpans[row])
+        return pixmap
+
+    def thumbnail_loaded(self, row, path, image, resolution):
+        # Failed loads are cached too, as an empty pixmap, so they are not retried on every paint
+        self.pixmaps.insert(path, QPixmap.fromImage(image))
+        if row >= len(self.paths) or self.paths[row] != path:
+            # Requested before the images were reloaded
+            return
+        if resolution.isValid():
+            self.resolutions[row] = resolution
+
+        viewRow = self.viewRows[row]
+        if viewRow >= 0:
+            index = self.index(int(viewRow))
+            self.dataChanged.emit(index, index)
+
+    def keep_loading(self, first, last):
+        # Prefetches the rows around the shown rows first to last and cancels the other queued
+        # thumbnails. Up to a screenful on each side, as far as the cache leaves room for it.
+        visibleCount = last - first + 1
+        cacheCount = self.pixmaps.budget // (THUMBNAIL_SIZE * THUMBNAIL_SIZE * 4)
+        prefetchCount = max(0, min(visibleCount, (cacheCount // 2 - visibleCount) // 2))
+
+        keep = set(self.rows[first:last + 1].tolist())
+        # Nearest rows first, alternating below and above
+        for distance in range(1, prefetchCount + 1):
+            for viewRow in (last + distance, first - distance):
+                if 0 <= viewRow < len(self.rows):
+                    row = int(self.rows[viewRow])
+                    keep.add(row)
+                    if self.paths[row] not in self.pixmaps:
+                        self.thumbnailLoader.request(row, self.paths[row], self.thumbnailSpans[row], prefetch=True)
+        self.thumbnailLoader.cancel_except(keep)
+
+    def cache_stats(self):
+        return self.pixmaps.stats()
+
+    def stop(self):
+        self.thumbnailLoader.stop()
+
+
+class ImageDelegate(QStyledItemDelegate):
+    # Paints a thumbnail with its resolution, file size and name, all cells have the same size
+    def sizeHint(self, option, index):
+        return QSize(THUMBNAIL_SIZE + 2 * PADDING, THUMBNAIL_SIZE + 2 * self.text_height(option))
+
+    def text_height(self, option):
+        return option.fontMetrics.height() + 2 * PADDING
+
+    def paint(self, painter, option, index):
+        painter.save()
+        rect = option.rect.adjusted(0, 0, -1, -1)
+        textHeight = self.text_height(option)
+
+        painter.setPen(QColor("#444"))
+        painter.drawRect(rect)
+
+        pixmap = index.data(Qt.ItemDataRole.DecorationRole)
+        imageRect = QRect(rect.x(), rect.y(), rect.width(), rect.height() - 2 * textHeight)
+        if pixmap is None:
+            # Still loading
+            placeholder = QRect(0, 0, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+            placeholder.moveCenter(imageRect.center())
+            painter.fillRect(placeholder, QColor(PLACEHOLDER_COLOR))
+        elif not pixmap.isNull():
+            x = imageRect.x() + (imageRect.width() - pixmap.width()) // 2
+            y = imageRect.y() + (imageRect.height() - pixmap.height()) // 2
+            painter.drawPixmap(x, y, pixmap)
+
+        painter.setPen(option.palette.text().color())
+        statsRect = QRect(rect.x() + PADDING, imageRect.bottom(), rect.width() - 2 * PADDING, textHeight)
+        painter.drawText(statsRect, Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter, index.data(ResolutionRole))
+        painter.drawText(statsRect, Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter, index.data(SizeRole))
+
+        nameRect = statsRect.translated(0, textHeight)
+        filename = option.fontMetrics.elidedText(index.data(), Qt.TextElideMode.ElideRight, nameRect.width())
+        painter.drawText(nameRect, Qt.AlignmentFlag.AlignCenter, filename)
+        painter.restore()
+
+
+class ImageGridView(QListView):
+    # Lays the cells out in a grid and only paints the ones in the viewport
+    viewportSettled = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setViewMode(QListView.ViewMode.IconMode)
+        self.setResizeMode(QListView.ResizeMode.Adjust)
+        self.setMovement(QListView.Movement.Static)
+        self.setUniformItemSizes(True)
+        self.setSpacing(SPACING)
+        self.setSelectionMode(QListView.SelectionMode.NoSelection)
+        self.setVerticalScrollMode(QListView.ScrollMode.ScrollPerPixel)
+        self.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.setStyleSheet("border: none;")
+        self.setItemDelegate(ImageDelegate(self))
+
+        self.cancelTimer = QTimer(self)
+        self.cancelTimer.setSingleShot(True)
+        self.cancelTimer.setInterval(CANCEL_DELAY)
+        self.cancelTimer.timeout.connect(self.cancel_hidden)
+        # Not connected to start directly, which would take the scroll position as the interval
+        self.verticalScrollBar().valueChanged.connect(lambda _: self.cancelTimer.start())
+
+    def setModel(self, model):
+        super().setModel(model)
+        model.modelReset.connect(lambda: self.cancelTimer.start())
+
+    def resizeEvent(self, e):
+        super().resizeEvent(e)
+        self.cancelTimer.start()
+
+    def visible_range(self):
+        # First and last shown row in the viewport, found by probing it every half cell
+        rows = []
+        viewport = self.viewport().rect()
+        step = THUMBNAIL_SIZE // 2
+        for y in list(range(0, viewport.height(), step)) + [viewport.height() - 1]:
+            for x in list(range(0, viewport.width(), step)) + [viewport.width() - 1]:
+                index = self.indexAt(QPoint(x, y))
+                if index.isValid():
+                    rows.append(index.row())
+        if not rows:
+            return None
+        return min(rows), max(rows)
+
+    def cancel_hidden(self):
+        model = self.model()
+        if model is None:
+            return
+        visibleRange = self.visible_range()
+        if visibleRange is None:
+            model.keep_loading(0, -1)
+        else:
+            model.keep_loading(*visibleRange)
+        self.viewportSettled.emit()
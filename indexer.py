@@ -0,0 +1,718 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from database import (
+    BatchedWriter, connect, create_tables, get_tag_id, sort_name, mark_directory_deleted, under_directory, directory_prefix
+)
+from exifOperations import WRITE_BATCH_SIZE
+from getTags import get_predictor
+from getText import ocrPool, OCR_POOL_SIZE
+from pipeline import Pipeline, Stage
+from thumbnailCache import ThumbnailWriter
+from scanWorker import (
+    ScanItem, hash_file, stat_signature, image_size, decode_item, tag_items,
+    read_item_text, update_item_files, init_worker, process_shard
+)
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp"}
+# Number of images sent to the tagging model in one inference call
+BATCH_SIZE = 8
+# Worker threads per pipeline stage, metadata workers hash the files again after rewriting them
+STAGE_WORKERS = {
+    "hash": 2,
+    "decode": 4,
+    "tag": 1,
+    "ocr": OCR_POOL_SIZE,
+    "metadata": 2,
+    "database": 1,
+}
+# Items waiting between two stages, a full queue blocks the stage before it
+QUEUE_SIZE = 4 * BATCH_SIZE
+# Worker processes for the multi-process mode, 0 runs the threaded pipeline in this process
+SCAN_PROCESSES = 0
+# The progress total is reported again after this many more files are found
+COUNT_INTERVAL = 500
+
+# Exit codes of the command line indexer
+EXIT_OK = 0
+EXIT_FILE_ERRORS = 1
+EXIT_MISSING_DIRECTORY = 2
+EXIT_FAILED = 3
+EXIT_INTERRUPTED = 130
+
+
+def is_image_file(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_image_files(directory, list_files=None):
+    # Yields (directory, file name) for every image below directory as the directories are read, so
+    # the scan starts before the whole tree is listed. list_files(path, stat) decides whether the
+    # images of a directory are listed. Subdirectories are always walked: a change inside one doesn't
+    # touch the mtime of its parent.
+    if not os.path.isdir(directory):
+        if os.path.isfile(directory) and is_image_file(directory):
+            yield os.path.dirname(directory), os.path.basename(directory)
+        return
+
+    pending = [directory]
+    while pending:
+        path = pending.pop()
+        try:
+            stat = os.stat(path)
+            with os.scandir(path) as entries:
+                entries = list(entries)
+        except OSError as e:
+            print(f"Error {path}: {e}", file=sys.stderr)
+            continue
+
+        listFiles = list_files is None or list_files(path, stat)
+        subdirectories = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif listFiles and is_image_file(entry.name) and entry.is_file():
+                    yield path, entry.name
+            except OSError:
+                continue
+        # Walked depth first in name order
+        pending.extend(sorted(subdirectories, reverse=True))
+
+
+def top_directories(directories):
+    # Drops repeated directories and the ones below another directory of the list, the scan of that one
+    # already covers them
+    paths = [os.path.normpath(directory) for directory in directories]
+    return [
+        directory for index, (directory, path) in enumerate(zip(directories, paths))
+        if path not in paths[:index] and not any(path.startswith(os.path.join(other, "")) for other in paths)
+    ]
+
+
+class IndexListener:
+    # Progress callbacks of an Indexer, called from its worker threads
+    def item_count(self, total):
+        pass
+
+    def processed_file(self, filePath):
+        pass
+
+    def progress(self, processedIndex, averageTime):
+        pass
+
+
+class Indexer:
+    def __init__(self, directory, delete, write, batchSize=BATCH_SIZE, workers=None, processes=SCAN_PROCESSES, threadsPerProcess=None, listener=None, files=None, full=False):
+        # Paths are stored normalized, so a file has one row however the directory above it was spelled
+        self.directory = os.path.normpath(directory)
+        # (directory, file name) pairs to scan, every image below directory when None
+        self.files = files
+        # Check the files of unchanged directories too, e.g. for edits that don't change a directory's mtime
+        self.full = full
+        self.delete = delete
+        self.write = write
+        self.batchSize = batchSize
+        self.workers = {**STAGE_WORKERS, **(workers or {})}
+        self.processes = processes
+        # Split the cores between the worker processes so ONNX Runtime and Paddle don't oversubscribe them
+        self.threadsPerProcess = threadsPerProcess or max(1, (os.cpu_count() or 1) // max(1, processes))
+        self.listener = listener or IndexListener()
+        self.running = True
+        self.progressLock = threading.Lock()
+        # Per-thread batch buffers for the tag workers
+        self.local = threading.local()
+        self.writeLock = threading.Lock()
+        # Tag name -> id in the tags table, filled as tags are written
+        self.tagIds = {}
+        # Directories listed during the scan and their mtime, stored once the scan completes, and
+        # the directories of files that failed so they're checked again next time
+        self.directoryTimes = {}
+        self.failedDirectories = set()
+        # Directories whose images were listed and the files found in them, rows of other files in
+        # them are marked deleted once the scan completes
+        self.listedDirectories = []
+        self.seenFiles = {}
+        # Rows of missing files already taken over by a moved file in this scan
+        self.claimedRows = set()
+        # contentSha -> item being tagged for it, changed with writeLock held
+        self.inFlight = {}
+        # Ids of the rows written, revived or marked deleted, for updating the GUI's filter index.
+        # Changed with writeLock held.
+        self.changedIds = set()
+
+        self.startTime = time.time()
+        self.total = 0
+        self.processedCount = 0
+        self.skipped = 0
+        self.errors = 0
+        # Files that were copies of indexed images, or indexed images moved while nothing was watching
+        self.reusedCount = 0
+        self.movedCount = 0
+        self.pipeline = None
+        # Seconds and item counts per step in the multi-process mode
+        self.stageTimes = {}
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        conn = connect()
+
+        create_tables(conn)
+
+        self.startTime = time.time()
+        self.total = 0
+        # Only connection writing during the scan, shared by every thread under writeLock
+        self.writeConn = connect(check_same_thread=False)
+        self.writer = BatchedWriter(self.writeConn)
+        self.thumbnails = ThumbnailWriter()
+
+        if self.files is None:
+            fileList = iter_image_files(self.directory, partial(self.list_directory, conn.cursor()))
+        else:
+            fileList = iter(self.files)
+        items = self.changed_files(conn, fileList)
+        if self.processes > 0:
+            self.run_processes(items)
+        else:
+            self.run_pipeline(items)
+
+        self.listener.item_count(self.total)
+        with self.writeLock:
+            if self.running and self.files is None:
+                self.mark_missing_files()
+                self.mark_missing_directories()
+                self.store_directory_times()
+            self.writer.commit()
+        self.thumbnails.close()
+        self.writeConn.close()
+        conn.close()
+
+    def changed_files(self, conn, fileList):
+        # Yields the files that are new or changed since the last scan
+        cursor = conn.cursor()
+        for directory, file in fileList:
+            if not self.running:
+                break
+            directory = os.path.normpath(directory)
+            filePath = os.path.join(directory, file)
+            self.total += 1
+            if self.total % COUNT_INTERVAL == 0:
+                self.listener.item_count(self.total)
+
+            try:
+                stat = os.stat(filePath)
+            except OSError as e:
+                self.file_error(filePath, e)
+                continue
+            signature = stat_signature(stat)
+
+            # Check if it already exists in database
+            checkIfExistQuery = "SELECT id, shaValue, fileSize, mtime, inode, ctime, width, deleted FROM images WHERE path = ? AND filename = ?"
+            cursor.execute(checkIfExistQuery, (directory, file))
+            result = cursor.fetchone()
+            self.seenFiles.setdefault(directory, set()).add(file)
+            rowId = None
+            if result:
+                rowId = result[0]
+                # A file marked deleted that is back is checked by content
+                if tuple(result[2:5]) == signature and not result[7]:
+                    if result[5] is None or result[6] is None:
+                        # Scanned before the sort keys were stored
+                        self.refresh_row(rowId, filePath, stat, result[6] is None, False)
+                    self.skip_item()
+                    continue
+
+            item = ScanItem(filePath, directory, file, rowId)
+            if rowId is not None:
+                # Size or mtime changed, or the row predates stat tracking: the hash stage compares the content
+                item.storedSha, item.sizeMissing, item.storedDeleted = result[1], result[6] is None, bool(result[7])
+            yield item
+
+    def run_pipeline(self, items):
+        # One OCR engine per OCR worker, the models are loaded once and reused for every file
+        ocrPool.grow(self.workers["ocr"])
+        ocrPool.warm_up()
+
+        # hash -> decode -> tag -> OCR -> metadata -> database, each stage on its own threads. Copies
+        # of indexed images pass through decode, tag and OCR untouched.
+        self.pipeline = Pipeline([
+            Stage("hash", self.hash_item, self.workers["hash"], QUEUE_SIZE),
+            Stage("decode", self.decode_image, self.workers["decode"], QUEUE_SIZE),
+            Stage("tag", self.tag_images, self.workers["tag"], QUEUE_SIZE, self.batchSize),
+            Stage("ocr", self.read_text, self.workers["ocr"], QUEUE_SIZE),
+            Stage("metadata", self.update_files, self.workers["metadata"], QUEUE_SIZE, WRITE_BATCH_SIZE),
+            Stage("database", self.write_row, self.workers["database"], QUEUE_SIZE),
+        ], self.stage_error)
+        self.pipeline.start()
+
+        for item in items:
+            # Blocks while the decode queue is full
+            self.pipeline.put(item)
+
+        self.pipeline.close()
+        self.pipeline.join()
+
+    def run_processes(self, items):
+        # The database connection isn't shared with the pool's feeder thread, so list the files first.
+        # Copies of indexed images are finished here and never reach the workers, copies of another file
+        # of the scan wait for its results.
+        items = self.hash_items(list(items))
+        reused = [item for item in items if item.reused]
+        for start in range(0, len(reused), WRITE_BATCH_SIZE):
+            batch = reused[start:start + WRITE_BATCH_SIZE]
+            for item in batch:
+                self.listener.processed_file(item.filePath)
+            startTime = time.perf_counter()
+            try:
+                batch = self.updated_items(update_item_files(batch, self.delete, self.write))
+            except Exception as e:
+                self.stage_error(batch, e)
+                continue
+            self.add_stage_time("metadata", time.perf_counter() - startTime, len(batch))
+            for item in batch:
+                self.write_row(item)
+        items = [item for item in items if not item.reused]
+        shards = [items[start:start + self.batchSize] for start in range(0, len(items), self.batchSize)]
+
+        # Spawned workers each load their own predictor and OCR engine once, this process stays the only writer
+        context = multiprocessing.get_context("spawn")
+        initArgs = (self.threadsPerProcess, self.threadsPerProcess, self.batchSize)
+        with context.Pool(self.processes, initializer=init_worker, initargs=initArgs) as pool:
+            work = partial(process_shard, delete=self.delete, write=self.write)
+            for shard, timings in pool.imap_unordered(work, shards):
+                for name, seconds in timings.items():
+                    self.add_stage_time(name, seconds, len(shard))
+                for item in shard:
+                    if item.error is not None:
+                        self.item_error(item, item.error)
+                    else:
+                        self.listener.processed_file(item.filePath)
+                        startTime = time.perf_counter()
+                        self.write_row(item)
+                        self.add_stage_time("database", time.perf_counter() - startTime, 1)
+                if not self.running:
+                    pool.terminate()
+                    break
+
+    def hash_items(self, items):
+        # Hashes the files for the multi-process mode, on threads since hashing releases the GIL
+        def hash_or_skip(item):
+            startTime = time.perf_counter()
+            try:
+                item = self.hash_item(item)
+            except Exception as e:
+                self.file_error(item.filePath, e)
+                return None
+            self.add_stage_time("hash", time.perf_counter() - startTime, 1)
+            return item
+
+        with ThreadPoolExecutor(self.workers["hash"]) as executor:
+            return [item for item in executor.map(hash_or_skip, items) if item is not None]
+
+    def list_directory(self, cursor, path, stat):
+        # Called by iter_image_files, the images of a directory are only listed when it changed
+        path = os.path.normpath(path)
+        self.directoryTimes[path] = stat.st_mtime_ns
+        if not self.full:
+            row = cursor.execute("SELECT mtime FROM directories WHERE path = ?", (path,)).fetchone()
+            if row is not None and row[0] == stat.st_mtime_ns:
+                return False
+        self.listedDirectories.append(path)
+        return True
+
+    def mark_missing_files(self):
+        # Called with writeLock held. Files of a listed directory that weren't found were deleted or
+        # moved away while nothing was watching, moves found by content were handled already.
+        for directory in self.listedDirectories:
+            seen = self.seenFiles.get(directory, set())
+            rows = self.writeConn.execute("SELECT id, filename FROM images WHERE path = ? AND deleted = 0", (directory,)).fetchall()
+            missing = [imageId for imageId, name in rows if name not in seen and not os.path.exists(os.path.join(directory, name))]
+            if missing:
+                self.writer.executemany("UPDATE images SET deleted = 1 WHERE id = ?", [(imageId,) for imageId in missing])
+                self.changedIds.update(missing)
+
+    def mark_missing_directories(self):
+        # Called with writeLock held. Directories below the scanned one that weren't walked were
+        # deleted while nothing was watching, their rows are never reached by mark_missing_files.
+        if not os.path.isdir(self.directory):
+            return
+        imageQuery = f"SELECT DISTINCT path FROM images WHERE deleted = 0 AND {under_directory('path')}"
+        paths = {row[0] for row in self.writeConn.execute(imageQuery, (self.directory, *directory_prefix(self.directory)))}
+        directoryQuery = f"SELECT path FROM directories WHERE {under_directory('path')}"
+        paths.update(row[0] for row in self.writeConn.execute(directoryQuery, (self.directory, *directory_prefix(self.directory))))
+        for path in sorted(paths):
+            if path not in self.directoryTimes and not os.path.isdir(path):
+                idQuery = f"SELECT id FROM images WHERE deleted = 0 AND {under_directory('path')}"
+                self.changedIds.update(row[0] for row in self.writeConn.execute(idQuery, (path, *directory_prefix(path))))
+                mark_directory_deleted(self.writer, path)
+
+    def store_directory_times(self):
+        # Called with writeLock held
+        rows = [(path, mtime) for path, mtime in self.directoryTimes.items() if path not in self.failedDirectories]
+        self.writer.executemany("INSERT OR REPLACE INTO directories (path, mtime) VALUES (?, ?)", rows)
+
+    def hash_item(self, item):
+        # New and changed files are hashed before any inference. Content already indexed under another path
+        # reuses its results, and takes over the row when the file there is gone.
+        if not self.running:
+            return None
+        item.sha, stat = hash_file(item.filePath)
+        item.contentSha = item.sha
+        item.signature = stat_signature(stat)
+        item.ctime = stat.st_ctime_ns
+        if item.rowId is not None and item.sha == item.storedSha:
+            # Only the stat changed
+            self.refresh_row(item.rowId, item.filePath, stat, item.sizeMissing, item.storedDeleted)
+            self.skip_item()
+            return None
+        with self.writeLock:
+            original = self.inFlight.get(item.sha)
+            if original is not None:
+                # The same content is still being tagged, finished together with it
+                original.copies.append(item)
+                return None
+            # The write connection also sees copies written earlier in this scan
+            self.reuse_results(item)
+            if not item.reused:
+                self.inFlight[item.sha] = item
+        return item
+
+    def reuse_results(self, item):
+        # Called with writeLock held
+        rows = self.writeConn.execute("SELECT id, path, filename, deleted FROM images WHERE shaValue = ? AND id IS NOT ?", (item.sha, item.rowId)).fetchall()
+        if not rows:
+            return
+        sourceId = rows[0][0]
+        if item.rowId is None:
+            for rowId, path, filename, deleted in rows:
+                if rowId not in self.claimedRows and (deleted or not os.path.exists(os.path.join(path, filename))):
+                    # Keeps the id, and with it the favorite flag
+                    sourceId = item.movedFrom = rowId
+                    self.claimedRows.add(rowId)
+                    break
+
+        tags, text, item.width, item.height = self.writeConn.execute("SELECT tags, text, width, height FROM images WHERE id = ?", (sourceId,)).fetchone()
+        item.tags = tags or ""
+        item.text = text or ""
+        tagQuery = "SELECT tags.name, image_tags.score FROM image_tags JOIN tags ON tags.id = image_tags.tag_id WHERE image_tags.image_id = ?"
+        tagRows = self.writeConn.execute(tagQuery, (sourceId,)).fetchall()
+        item.tagNames = [name for name, _ in tagRows]
+        item.scores = [score for _, score in tagRows]
+        item.reused = True
+        with self.progressLock:
+            if item.movedFrom is None:
+                self.reusedCount += 1
+            else:
+                self.movedCount += 1
+
+    def decode_image(self, item):
+        if not self.running:
+            return None
+        if item.reused:
+            return item
+        return decode_item(item)
+
+    def tag_images(self, items):
+        if not self.running:
+            return None
+        batchBuffer = getattr(self.local, "batchBuffer", None)
+        if batchBuffer is None:
+            batchBuffer = self.local.batchBuffer = get_predictor().allocate_batch(self.batchSize)
+        toTag = [item for item in items if not item.reused]
+        if toTag:
+            tag_items(toTag, batchBuffer)
+        return items
+
+    def read_text(self, item):
+        if not self.running:
+            return None
+        self.listener.processed_file(item.filePath)
+        if item.reused:
+            return item
+        return read_item_text(item)
+
+    def update_files(self, items):
+        if not self.running:
+            return None
+        return self.updated_items(update_item_files(items, self.delete, self.write))
+
+    def updated_items(self, items):
+        # Items whose metadata couldn't be written are reported and dropped, their copies still use the results
+        for item in items:
+            if item.error is not None:
+                self.file_error(item.filePath, item.error)
+                self.write_copies(item)
+        return [item for item in items if item.error is None]
+
+    def refresh_row(self, rowId, filePath, stat, readSize, revived):
+        # Stores the current stat of an unchanged file, and its dimensions when they're missing
+        width = height = None
+        if readSize:
+            try:
+                width, height = image_size(filePath)
+            except Exception:
+                pass
+        refreshQuery = '''
+            UPDATE images SET fileSize = ?, mtime = ?, inode = ?, ctime = ?, width = COALESCE(width, ?), height = COALESCE(height, ?),
+                deleted = 0
+            WHERE id = ?
+        '''
+        with self.writeLock:
+            self.writer.execute(refreshQuery, (*stat_signature(stat), stat.st_ctime_ns, width, height, rowId))
+            if revived:
+                self.changedIds.add(rowId)
+
+    def write_row(self, item):
+        with self.writeLock:
+            # Resolved before anything is written, so a bad tag can't leave a row without its tags.
+            # Scores are unknown (NULL) for tags migrated from the old tags column.
+            tagScores = [(self.tag_id(name), None if score is None else float(score)) for name, score in zip(item.tagNames, item.scores)]
+
+            # Write to database, a row that appeared since the check (e.g. from the folder watcher) is updated
+            if item.movedFrom is not None:
+                # Same content as a missing file, only its location changes
+                moveQuery = '''
+                    UPDATE images SET shaValue = ?, path = ?, filename = ?, sortName = ?, fileSize = ?, mtime = ?, inode = ?, ctime = ?,
+                        deleted = 0
+                    WHERE id = ?
+                '''
+                self.writer.execute(moveQuery, (item.sha, item.directory, item.file, sort_name(item.file), *item.signature, item.ctime, item.movedFrom))
+                self.changedIds.add(item.movedFrom)
+                self.report_progress()
+                return None
+            if item.rowId is None:
+                insertQuery = '''
+                    INSERT INTO images (shaValue, path, filename, tags, text, fileSize, mtime, inode, ctime, width, height, sortName)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (path, filename) DO UPDATE SET shaValue = excluded.shaValue, tags = excluded.tags, text = excluded.text,
+                        fileSize = excluded.fileSize, mtime = excluded.mtime, inode = excluded.inode, ctime = excluded.ctime,
+                        width = excluded.width, height = excluded.height, sortName = excluded.sortName, deleted = 0
+                '''
+                self.writer.execute(insertQuery, (
+                    item.sha, item.directory, item.file, item.tags, item.text, *item.signature,
+                    item.ctime, item.width, item.height, sort_name(item.file)
+                ))
+                imageId = self.writeConn.execute("SELECT id FROM images WHERE path = ? AND filename = ?", (item.directory, item.file)).fetchone()[0]
+            else:
+                # The file changed since it was scanned, replace the old results
+                updateQuery = '''
+                    UPDATE images SET shaValue = ?, tags = ?, text = ?, fileSize = ?, mtime = ?, inode = ?, ctime = ?, width = ?, height = ?,
+                        deleted = 0
+                    WHERE id = ?
+                '''
+                self.writer.execute(updateQuery, (item.sha, item.tags, item.text, *item.signature, item.ctime, item.width, item.height, item.rowId))
+                imageId = item.rowId
+
+            self.changedIds.add(imageId)
+            self.writer.execute("DELETE FROM image_tags WHERE image_id = ?", (imageId,))
+            tagRows = [(tagId, imageId, score) for tagId, score in tagScores]
+            self.writer.executemany("INSERT OR IGNORE INTO image_tags (tag_id, image_id, score) VALUES (?, ?, ?)", tagRows)
+            self.write_thumbnail(item)
+        self.report_progress()
+        self.write_copies(item)
+        return None
+
+    def release_sha(self, item):
+        # Called with writeLock held. Compared by path, items come back from the worker processes as new objects.
+        original = self.inFlight.get(item.contentSha)
+        if original is not None and original.filePath == item.filePath:
+            del self.inFlight[item.contentSha]
+
+    def write_copies(self, item):
+        # Called once the results of item are final. Its copies take them from memory: with metadata
+        # written, the row of item no longer has their hash.
+        with self.writeLock:
+            self.release_sha(item)
+        copies = item.copies
+        if not copies:
+            return
+        for copy in copies:
+            copy.tags, copy.text, copy.tagNames, copy.scores = item.tags, item.text, item.tagNames, item.scores
+            copy.width, copy.height, copy.thumbnail = item.width, item.height, item.thumbnail
+            copy.reused = True
+            self.listener.processed_file(copy.filePath)
+        with self.progressLock:
+            self.reusedCount += len(copies)
+        try:
+            copies = self.updated_items(update_item_files(copies, self.delete, self.write))
+        except Exception as e:
+            self.stage_error(copies, e)
+            return
+        for copy in copies:
+            self.write_row(copy)
+
+    def write_thumbnail(self, item):
+        # Called with writeLock held, copies of an image share one thumbnail
+        if item.thumbnail is None:
+            return
+        if self.writeConn.execute("SELECT 1 FROM thumbnails WHERE shaValue = ?", (item.sha,)).fetchone():
+            return
+        offset = self.thumbnails.append(item.thumbnail)
+        # Another process can store the same content between the check and the insert, its entry is kept
+        self.writer.execute("INSERT OR IGNORE INTO thumbnails (shaValue, offset, length) VALUES (?, ?, ?)", (item.sha, offset, len(item.thumbnail)))
+        item.thumbnail = None
+
+    def tag_id(self, name):
+        # Called with writeLock held
+        tagId = self.tagIds.get(name)
+        if tagId is None:
+            tagId = self.tagIds[name] = get_tag_id(self.writeConn.cursor(), name)
+        return tagId
+
+    def stage_error(self, items, error):
+        for item in items:
+            self.item_error(item, error)
+
+    def item_error(self, item, error):
+        # Copies waiting for the item fail with it
+        with self.writeLock:
+            self.release_sha(item)
+        for failed in [item, *item.copies]:
+            self.file_error(failed.filePath, error)
+
+    def file_error(self, filePath, error):
+        print(f"Error {filePath}: {error}", file=sys.stderr)
+        with self.progressLock:
+            self.errors += 1
+            self.failedDirectories.add(os.path.dirname(filePath))
+        self.skip_item()
+
+    def skip_item(self):
+        self.report_progress(skipped=True)
+
+    def report_progress(self, skipped=False):
+        # Both counters change in one critical section, the average only covers files that were indexed
+        with self.progressLock:
+            if skipped:
+                self.skipped += 1
+            processedCount = self.processedCount
+            self.processedCount += 1
+            average = (time.time() - self.startTime) / max(1, self.processedCount + 1 - self.skipped)
+        self.listener.progress(processedCount, average)
+
+    def add_stage_time(self, name, seconds, items):
+        with self.progressLock:
+            total = self.stageTimes.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += items
+
+    def stage_latency(self):
+        # Average milliseconds per file spent in each stage
+        if self.pipeline is not None:
+            times = {stage.name: (stage.busyTime, stage.itemsDone) for stage in self.pipeline.stages}
+        else:
+            with self.progressLock:
+                times = {name: tuple(total) for name, total in self.stageTimes.items()}
+        return {name: round(seconds / items * 1000, 1) for name, (seconds, items) in times.items() if items}
+
+    def stats(self):
+        with self.progressLock:
+            done = self.processedCount
+            skipped = self.skipped
+            errors = self.errors
+            reused = self.reusedCount
+            moved = self.movedCount
+        elapsed = time.time() - self.startTime
+        indexed = done - skipped
+        # Unchanged files are skipped almost for free, so the rate only counts indexed files
+        filesPerSecond = indexed / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, self.total - done)
+        eta = remaining / filesPerSecond if filesPerSecond > 0 else None
+        return {
+            "directory": self.directory,
+            "total": self.total,
+            "done": done,
+            "indexed": indexed,
+            "reused": reused,
+            "moved": moved,
+            "skipped": skipped - errors,
+            "errors": errors,
+            "elapsed": round(elapsed, 1),
+            "filesPerSecond": round(filesPerSecond, 2),
+            "eta": round(eta, 1) if eta is not None else None,
+            "stageLatencyMs": self.stage_latency(),
+        }
+
+
+def print_stats(event, stats, asJson):
+    if asJson:
+        print(json.dumps({"event": event, **stats}), flush=True)
+        return
+
+    latency = " ".join(f"{name} {ms}ms" for name, ms in stats["stageLatencyMs"].items())
+    eta = f"{stats['eta']:.0f}s" if stats["eta"] is not None else "-"
+    print(
+        f"[{event}] {stats['directory']}: {stats['done']}/{stats['total']} files, "
+        f"{stats['indexed']} indexed ({stats['reused']} copies, {stats['moved']} moved), {stats['skipped']} unchanged, {stats['errors']} errors, "
+        f"{stats['filesPerSecond']} files/s, ETA {eta}" + (f", {latency}" if latency else ""),
+        flush=True,
+    )
+
+
+def run_indexer(indexer, failures):
+    try:
+        indexer.run()
+    except Exception as e:
+        print(f"Error {indexer.directory}: {e}", file=sys.stderr)
+        failures.append(e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index image directories into imageTagger.db without the GUI.")
+    parser.add_argument("directories", nargs="+", help="directories or image files to index")
+    parser.add_argument("--delete-metadata", action="store_true", help="delete all metadata from indexed images")
+    parser.add_argument("--write-metadata", action="store_true", help="write tags and text to image metadata")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="images per inference call")
+    parser.add_argument("--processes", type=int, default=SCAN_PROCESSES, help="worker processes, 0 uses threads in this process")
+    parser.add_argument("--threads", type=int, default=None, help="inference threads per worker process")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between progress reports")
+    parser.add_argument("--json", action="store_true", help="print progress as JSON lines")
+    parser.add_argument("--full", action="store_true", help="check every file, also in directories that haven't changed")
+    args = parser.parse_args(argv)
+
+    status = EXIT_OK
+    for directory in top_directories(args.directories):
+        if not os.path.exists(directory):
+            print(f"Error {directory}: no such file or directory", file=sys.stderr)
+            status = max(status, EXIT_MISSING_DIRECTORY)
+            continue
+
+        indexer = Indexer(
+            directory, args.delete_metadata, args.write_metadata,
+            batchSize=args.batch_size, processes=args.processes, threadsPerProcess=args.threads, full=args.full,
+        )
+        failures = []
+        worker = threading.Thread(target=run_indexer, args=(indexer, failures), daemon=True)
+        worker.start()
+        try:
+            while worker.is_alive():
+                worker.join(args.interval)
+                if worker.is_alive():
+                    print_stats("progress", indexer.stats(), args.json)
+        except KeyboardInterrupt:
+            indexer.stop()
+            worker.join()
+            print_stats("interrupted", indexer.stats(), args.json)
+            return EXIT_INTERRUPTED
+
+        stats = indexer.stats()
+        if failures:
+            print_stats("failed", stats, args.json)
+            status = max(status, EXIT_FAILED)
+            continue
+        print_stats("finished", stats, args.json)
+        if stats["errors"]:
+            status = max(status, EXIT_FILE_ERRORS)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,52 +1,31 @@
 import sys
-import os
-import time
-import sqlite3
 import qdarktheme
 import subprocess
 import scan
 import ctypes
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QPushButton, QLabel, QFileDialog,
-    QVBoxLayout, QHBoxLayout, QScrollArea, QGridLayout, QFrame,
-    QProgressBar, QTabWidget, QComboBox, QLineEdit, QListWidget,
+    QVBoxLayout, QHBoxLayout, QTabWidget, QComboBox, QLineEdit, QListWidget,
     QCheckBox, QMessageBox, QMenu
 )
 from PyQt6.QtGui import QPixmap, QDesktopServices, QGuiApplication, QColor, QPalette, QCursor, QIcon
 from PyQt6.QtCore import Qt, QUrl, QTimer
 from scan import ProgressBarWindow
+from database import connect, create_tables, drop_image_tables, text_match_query
+from filterIndex import FilterIndex
+from indexer import top_directories
+from imageGrid import IdRole, PathRole, ImageGridView, ImageListModel, format_size
+from searchWorker import SearchWorker
 from multiComboBoxWithSearch import MultiSelectComboBoxWithSearch
 
-myappid = 'mycompany.myproduct.subproduct.version' # arbitrary string
-ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
+if sys.platform == "win32":
+    myappid = 'mycompany.myproduct.subproduct.version' # arbitrary string
+    ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
 
-conn = sqlite3.connect("imageTagger.db")
+conn = connect()
 cursor = conn.cursor()
 
-cursor.execute('''
-        CREATE TABLE IF NOT EXISTS settings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            directory VARCHAR(3000),
-            deleteMetadata BOOLEAN,
-            writeMetadata BOOLEAN,
-            autoScan BOOLEAN
-        )
-    ''')
-conn.commit()
-
-cursor.execute('''
-            CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                shaValue CHAR(64),
-                path VARCHAR(2000),
-                filename VARCHAR(2000),
-                tags VARCHAR(2000),
-                text VARCHAR(3000),
-                desc VARCHAR(4000),
-                favorites BOOLEAN
-            )
-        ''')
-conn.commit()
+create_tables(conn)
 
 cursor.execute("INSERT INTO settings (id,deleteMetadata,writeMetadata,autoScan) VALUES (1,0,0,0) ON CONFLICT (id) DO NOTHING")
 conn.commit()
@@ -55,6 +34,8 @@ searchText = ""
 searchTags = []
 filterTags = []
 fav = False
+# Milliseconds the search box has to be idle before a search starts
+SEARCH_DELAY = 150
 
 
 class ImageTagger(QWidget):
@@ -112,7 +93,11 @@ class ImageTagger(QWidget):
 
         self.searchBox = QLineEdit(self)
         self.searchBox.setPlaceholderText("Search images... (tags:train car cloud text:)")
-        self.searchBox.textChanged.connect(self.search_images)
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.setInterval(SEARCH_DELAY)
+        self.searchTimer.timeout.connect(self.search_images)
+        self.searchBox.textChanged.connect(self.searchTimer.start)
         searchBoxLayout.addWidget(self.searchBox)
 
         self.combo = MultiSelectComboBoxWithSearch()
@@ -123,27 +108,22 @@ class ImageTagger(QWidget):
         layout.addLayout(searchBoxLayout)
 
         # Images area
-        self.scrollArea = QScrollArea(self)
-        self.scrollArea.setWidgetResizable(True)
-        self.scrollArea.setStyleSheet("border: none;")
-
-        layout.addWidget(self.scrollArea)
-
-        self.container = QWidget()
-        self.scrollArea.setWidget(self.container)
-
-        self.gridLayout = QGridLayout(self.container)
-        self.container.setLayout(self.gridLayout)
+        self.imageModel = ImageListModel()
+        self.imageGrid = ImageGridView(self)
+        self.imageGrid.setModel(self.imageModel)
+        self.imageGrid.clicked.connect(self.open_image)
+        self.imageGrid.customContextMenuRequested.connect(self.grid_context_menu)
+        self.imageGrid.viewportSettled.connect(self.show_cache_stats)
+        layout.addWidget(self.imageGrid)
+
+        self.noImageLabel = QLabel("No images to display, scan folder first", self)
+        self.noImageLabel.setVisible(False)
+        layout.addWidget(self.noImageLabel)
 
         # Info strip
         infoStripLayout = QVBoxLayout()
         infoStripLayout.setContentsMargins(5, 5, 5, 5)
 
-            # Progress bar
-        self.progressBar = QProgressBar(self)
-        self.progressBar.setVisible(False)
-        infoStripLayout.addWidget(self.progressBar)
-
         infoStripLayoutHorizontal = QHBoxLayout()
 
             # Image count
@@ -157,141 +137,42 @@ class ImageTagger(QWidget):
         self.sortList.currentTextChanged.connect(self.sort_images)
         infoStripLayoutHorizontal.addWidget(self.sortList)
 
-            # Timer when loading
-        self.etaTimer = QLabel("", self)
-        self.etaTimer.setAlignment(Qt.AlignmentFlag.AlignRight)
-        infoStripLayoutHorizontal.addWidget(self.etaTimer)
-
         infoStripLayout.addLayout(infoStripLayoutHorizontal)
         layout.addLayout(infoStripLayout)
 
-        self.imageWidgets = []
-        self.currentColumns = 0
-        self.resizeTimer = QTimer(self)
-        self.resizeTimer.setSingleShot(True)
-        self.resizeTimer.timeout.connect(self.rearrange_grid)
+        self.filterIndex = FilterIndex()
+        self.searchWorker = SearchWorker(self.filterIndex)
+        self.searchWorker.resultsReady.connect(self.show_search_results)
+        self.searchWorker.start()
 
     def load_images(self):
-        cursor.execute("SELECT id, path, filename FROM images")
-        result = cursor.fetchall()
-        if result:
-            startTime = time.time()
-            self.imageWidgets.clear()
-            self.progressBar.setMaximum(len(result))
-            self.progressBar.setValue(0)
-            self.progressBar.setVisible(True)
-            for index, (id, path, filename) in enumerate(result):
-                fullPath = os.path.normpath(os.path.join(path, filename))
-
-                pixmap = QPixmap(fullPath)
-                if pixmap.isNull():
-                    continue
-
-                frame = QFrame(self)
-                frame.setObjectName(f"{id}")
-                frame.setProperty("visibility", True)
-                frame.setProperty("fullPath", fullPath)
-                frameLayout = QVBoxLayout(frame)
-                frameLayout.setContentsMargins(0, 0, 0, 0)
-                frameLayout.setSpacing(0)
-                frame.setStyleSheet("""
-                    QFrame {
-                        border: 1px solid #444;
-                    }
-                    QLabel {
-                        padding: 5px;
-                        border: none;
-                    }
-                """)
-
-                imageContent = QLabel(self)
-                thumbnail = pixmap.scaled(250, 250, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-                imageContent.setPixmap(thumbnail)
-                imageContent.setAlignment(Qt.AlignmentFlag.AlignCenter)
-
-                frame.mousePressEvent = lambda event, path=fullPath: self.open_image(event, path)
-                frame.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
-                frame.customContextMenuRequested.connect(lambda _, path=fullPath, ident=id: self.show_context_menu(path, ident))
-
-                statsLayout = QHBoxLayout()
-
-                resolutionLabel = QLabel(f"{pixmap.width()} x {pixmap.height()}", self)
-                resolutionLabel.setAlignment(Qt.AlignmentFlag.AlignLeft)
-                statsLayout.addWidget(resolutionLabel)
-
-                size = os.path.getsize(fullPath)
-                units = ["B", "KB", "MB", "GB"]
-                unitIndex = 0
-
-                while size >= 1024 and unitIndex < len(units) - 1:
-                    size /= 1024
-                    unitIndex += 1
-
-                sizeLabel = QLabel(f"{size:.2f} {units[unitIndex]}", self)
-                sizeLabel.setAlignment(Qt.AlignmentFlag.AlignRight)
-                statsLayout.addWidget(sizeLabel)
-
-                filenameLabel = QLabel(filename)
-                filenameLabel.setObjectName("filename")
-                if len(filename) >= 41:
-                    filenameLabel.setAlignment(Qt.AlignmentFlag.AlignLeft)
-                else:
-                    filenameLabel.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                filenameLabel.setStyleSheet("""
-                QLabel {
-                    max-width: 250px;
-                }
-                """)
-                filenameLabel.setToolTip(filename)
-
-                frameLayout.addWidget(imageContent)
-                frameLayout.addLayout(statsLayout)
-                frameLayout.addWidget(filenameLabel)
-                frame.setLayout(frameLayout)
-
-                self.imageWidgets.append(frame)
-                self.gridLayout.addWidget(frame)
-                self.progressBar.setValue(index + 1)
-                elapsedTime = time.time() - startTime
-                remainingTime = (elapsedTime / (index + 1)) * (len(result) - (index + 1))
-                self.etaTimer.setText(f"Estimated time remaining: {remainingTime:.1f} sec")
-
-            self.progressBar.setVisible(False)
-            self.imageCounter.setText(f"Images: {len(result)}")
-            self.rearrange_grid()
-            self.sort_images()
-            self.etaTimer.setText("")
-        else:
-            noImageLabel = QLabel("No images to display, scan folder first", self)
-            self.gridLayout.addWidget(noImageLabel)
+        self.filterIndex.load(cursor)
+        self.load_grid()
 
-    def rearrange_grid(self):
-        if not self.imageWidgets:
-            return
-
-        windowWidth = self.width()
-        imageSize = 250
-        spacing = 10
-        columns = max(1, windowWidth // (imageSize + spacing))
-
-        self.currentColumns = columns
-
-        row, col = 0, 0
-        for frame in self.imageWidgets:
-            if frame.property("visibility"):
-                self.gridLayout.addWidget(frame, row, col)
-                col += 1
-            if col >= columns:
-                col = 0
-                row += 1
+    def load_grid(self):
+        cursor.execute('''
+            SELECT images.id, path, filename, thumbnails.offset, thumbnails.length, fileSize, ctime, width, height, sortName FROM images
+            LEFT JOIN thumbnails ON thumbnails.shaValue = images.shaValue WHERE deleted = 0 ORDER BY images.id
+        ''')
+        result = cursor.fetchall()
+        self.imageModel.set_images(result)
+        self.imageCounter.setText(f"Images: {len(result)}")
+        self.noImageLabel.setVisible(not result)
+
+    def show_cache_stats(self):
+        stats = self.imageModel.cache_stats()
+        self.imageCounter.setToolTip(
+            f"Thumbnail cache: {stats['thumbnails']} thumbnails, {format_size(stats['bytes'])} of "
+            f"{format_size(stats['budget'])}, hit rate {stats['hitRate']:.0%}"
+        )
 
-    def resizeEvent(self, a0):
-        self.resizeTimer.start(50)
-        super().resizeEvent(a0)
+    def open_image(self, index):
+        QDesktopServices.openUrl(QUrl.fromLocalFile(index.data(PathRole)))
 
-    def open_image(self, event, path):
-        if event.button() == Qt.MouseButton.LeftButton:
-            QDesktopServices.openUrl(QUrl.fromLocalFile(path))
+    def grid_context_menu(self, pos):
+        index = self.imageGrid.indexAt(pos)
+        if index.isValid():
+            self.show_context_menu(index.data(PathRole), index.data(IdRole))
 
     def show_context_menu(self, path, id):
         menu = QMenu(self)
@@ -325,9 +206,10 @@ class ImageTagger(QWidget):
         elif action == addToFavorites:
             cursor.execute("UPDATE images SET favorites = CASE WHEN favorites = TRUE THEN FALSE ELSE TRUE END WHERE id = ?", (id,))
             conn.commit()
+            self.filterIndex.set_favorite(id, not (result and result[0] == 1))
 
     def search_images(self):
-        if not self.imageWidgets:
+        if not self.imageModel.image_count():
             return
 
         query = self.searchBox.text().lower().strip()
@@ -353,41 +235,17 @@ class ImageTagger(QWidget):
         self.image_hider()
 
     def sort_images(self):
-        match self.sortList.currentIndex():
-            case 0:
-                self.imageWidgets.sort(key=lambda f: f.findChild(QLabel, "filename").text().lower())
-                self.rearrange_grid()
-            case 1:
-                self.imageWidgets.sort(key=lambda f: f.findChild(QLabel, "filename").text().lower(), reverse=True)
-                self.rearrange_grid()
-            case 2:
-                self.imageWidgets.sort(key=lambda f: os.path.getsize(f.property("fullPath")))
-                self.rearrange_grid()
-            case 3:
-                self.imageWidgets.sort(key=lambda f: os.path.getsize(f.property("fullPath")), reverse=True)
-                self.rearrange_grid()
-            case 4:
-                self.imageWidgets.sort(key=lambda f: os.path.getctime(f.property("fullPath")), reverse=True)
-                self.rearrange_grid()
-            case 5:
-                self.imageWidgets.sort(key=lambda f: os.path.getctime(f.property("fullPath")))
-                self.rearrange_grid()
+        self.imageModel.sort_images(self.sortList.currentIndex())
 
     def pull_tags(self):
-        cursor.execute("SELECT tags FROM images")
+        # Most used first, counts are kept by the scanner
+        cursor.execute("SELECT name, imageCount FROM tags WHERE imageCount > 0 ORDER BY imageCount DESC, name")
         result = cursor.fetchall()
         if result:
-            tempTags = []
-            for row in result:
-                values = row[0].split(';')
-                values = [value for value in values if value]
-                tempTags.extend(values)
+            names = ["favorites"] + [row[0] for row in result]
+            counts = [None] + [row[1] for row in result]
 
-            tags = list(set(tempTags))
-            tags.sort()
-            tags.insert(0, "favorites")
-
-            self.combo.addItems(tags)
+            self.combo.set_tags(names, counts)
 
     def filter_tags(self, value):
         global filterTags
@@ -401,44 +259,28 @@ class ImageTagger(QWidget):
         self.image_hider()
 
     def image_hider(self):
-        sqlQuery = "SELECT id FROM images WHERE 1=1"
-
         global searchTags
         global searchText
+        global filterTags
+        tags = list(filterTags)
+        textQuery = ""
         if searchTags:
-            for tag in searchTags:
-                sqlQuery += f" AND tags LIKE '%{tag}%'"
+            tags.extend(tag for tag in searchTags if tag)
 
             if searchText != self.searchBox.text().lower().strip():
-                sqlQuery += f" AND text LIKE '%{searchText}%'"
+                textQuery = text_match_query(searchText)
         else:
-            sqlQuery += f" AND text LIKE '%{searchText}%'"
-
-        global filterTags
-        for tag in filterTags:
-            sqlQuery += f" AND tags LIKE '%{tag}%'"
+            textQuery = text_match_query(searchText)
 
+        # Runs on the search worker, only the results of the latest search are shown
         global fav
-        if fav:
-            sqlQuery += f" AND favorites LIKE 1"
+        self.searchWorker.search(tags, fav, textQuery)
 
-        cursor.execute(sqlQuery)
-        result = cursor.fetchall()
-        if result:
-            ids = {str(row[0]) for row in result}
-            for frame in self.imageWidgets:
-                if not frame.objectName() in ids:
-                    frame.setVisible(False)
-                    frame.setProperty("visibility", False)
-                else:
-                    frame.setVisible(True)
-                    frame.setProperty("visibility", True)
-        else:
-            for frame in self.imageWidgets:
-                frame.setVisible(False)
-                frame.setProperty("visibility", False)
+    def show_search_results(self, generation, result, ranked):
+        if not self.searchWorker.is_latest(generation):
+            return
 
-        self.rearrange_grid()
+        self.imageModel.set_visible(result, ranked)
 
     def init_settings_tab(self):
 
@@ -474,9 +316,15 @@ class ImageTagger(QWidget):
         databaseButtonLayout.addWidget(label)
 
         scanButton = QPushButton("Scan directories", self)
-        scanButton.clicked.connect(self.scanner)
+        scanButton.clicked.connect(lambda: self.scanner())
         databaseButtonLayout.addWidget(scanButton)
 
+        # Also checks the files of directories that look unchanged, e.g. after editing images in place
+        fullScanButton = QPushButton("Scan all files", self)
+        fullScanButton.setToolTip("Check every file, also in directories that haven't changed since the last scan")
+        fullScanButton.clicked.connect(lambda: self.scanner(full=True))
+        databaseButtonLayout.addWidget(fullScanButton)
+
         rebuildButton = QPushButton("Rebuild database", self)
         rebuildButton.clicked.connect(self.rebuild_database)
         databaseButtonLayout.addWidget(rebuildButton)
@@ -561,22 +409,34 @@ class ImageTagger(QWidget):
                 self.directories.insert(0, row[0])
             self.refresh_list()
 
-    def scanner(self):
+    def scanner(self, full=False):
         cursor.execute("SELECT directory FROM settings WHERE id != 1")
         result = cursor.fetchall()
         if result:
-            for row in result:
-                scan.isRunning = True
-                scan.scanWindow = ProgressBarWindow(row[0], self.deleteMetadataCheckbox.isChecked(), self.writeMetadataCheckbox.isChecked())
+            changedIds = set()
+            # A directory added below another one is scanned with it
+            for directory in top_directories([row[0] for row in result]):
+                scan.scanWindow = ProgressBarWindow(directory, self.deleteMetadataCheckbox.isChecked(), self.writeMetadataCheckbox.isChecked(), full=full)
                 scan.scanWindow.show()
                 scan.scanWindow.exec()
+                changedIds.update(scan.scanWindow.scan.indexer.changedIds)
+            self.images_changed(changedIds)
+
+    def images_changed(self, imageIds):
+        # Applies a scan to the filter index without reloading it, then redoes the current search
+        if not imageIds:
+            return
+        self.filterIndex.update_images(cursor, imageIds)
+        self.load_grid()
+        self.pull_tags()
+        self.image_hider()
 
     def delete_database(self):
         reply = QMessageBox.question(self, 'Confirm Deletion',
                                      f"Are you sure you want to delete image database",
                                      QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if reply == QMessageBox.StandardButton.Yes:
-            cursor.execute("DROP TABLE IF EXISTS images")
+            drop_image_tables(cursor)
             conn.commit()
 
     def rebuild_database(self):
@@ -584,11 +444,15 @@ class ImageTagger(QWidget):
                                      f"Are you sure you want to rebuild image database",
                                      QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if reply == QMessageBox.StandardButton.Yes:
-            cursor.execute("DROP TABLE IF EXISTS images")
+            drop_image_tables(cursor)
             conn.commit()
             self.scanner()
+            # Ids start over in the new tables, so the filter index is loaded again
+            self.load_images()
 
     def closeEvent(self, a0):
+        self.searchWorker.stop()
+        self.imageModel.stop()
         sys.exit(0)
 
 
@@ -1,6 +1,109 @@
+from bisect import bisect_left
+import numpy as np
 from PyQt6.QtWidgets import QComboBox, QLineEdit
-from PyQt6.QtGui import QStandardItem, QStandardItemModel
-from PyQt6.QtCore import Qt, QEvent, pyqtSignal
+from PyQt6.QtCore import Qt, QAbstractListModel, QEvent, QModelIndex, pyqtSignal
+
+# Tags added to the list each time it is scrolled to its end
+FETCH_SIZE = 200
+# A search matches the start of a tag or of any word in it
+WORD_SEPARATORS = "_ -:("
+
+
+class TagListModel(QAbstractListModel):
+    # Row 0 holds the search field, the other rows the tags matching the search, most used first.
+    # Matches are found by bisecting a sorted list of every word start of every tag, and rows are
+    # only added as the list is scrolled to its end.
+    def __init__(self, placeholderText, parent=None):
+        super().__init__(parent)
+        self.placeholderText = placeholderText
+        # Tags in frequency order, counts can be None for entries without one
+        self.names = []
+        self.counts = []
+        self.checked = set()
+        # (casefolded word start, tag index) pairs sorted by the word start
+        self.words = []
+        self.matches = np.empty(0, dtype=np.int64)
+        self.loaded = 0
+
+    def set_tags(self, names, counts):
+        # Tags that stay in the list stay checked. Shows no rows until filter is called.
+        checkedNames = {self.names[tag] for tag in self.checked}
+        self.show_matches(np.empty(0, dtype=np.int64))
+        self.names = list(names)
+        self.counts = list(counts)
+        self.checked = {index for index, name in enumerate(self.names) if name in checkedNames}
+        words = []
+        for index, name in enumerate(self.names):
+            folded = name.casefold()
+            for start in range(len(folded)):
+                if start == 0 or folded[start - 1] in WORD_SEPARATORS:
+                    words.append((folded[start:], index))
+        words.sort()
+        self.words = words
+
+    def filter(self, text):
+        prefix = text.casefold().strip()
+        if prefix:
+            first = bisect_left(self.words, (prefix,))
+            last = bisect_left(self.words, (prefix + chr(0x10FFFF),))
+            matches = np.unique(np.fromiter((index for _, index in self.words[first:last]), dtype=np.int64))
+        else:
+            matches = np.arange(len(self.names))
+        self.show_matches(matches)
+
+    def show_matches(self, matches):
+        # Rows are swapped without a reset, which would destroy the search field in row 0
+        if self.loaded:
+            self.beginRemoveRows(QModelIndex(), 1, self.loaded)
+            self.loaded = 0
+            self.endRemoveRows()
+        self.matches = matches
+        self.fetch_more()
+
+    def fetch_more(self):
+        # Adds the next FETCH_SIZE matches. Not Qt's fetchMore, which QComboBox calls until
+        # everything is loaded.
+        count = min(FETCH_SIZE, len(self.matches) - self.loaded)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.loaded + 1, self.loaded + count)
+        self.loaded += count
+        self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 1 + self.loaded
+
+    def flags(self, index):
+        if index.row() == 0:
+            return Qt.ItemFlag.NoItemFlags
+        return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsUserCheckable
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        if index.row() == 0:
+            return self.placeholderText if role == Qt.ItemDataRole.DisplayRole else None
+
+        tag = int(self.matches[index.row() - 1])
+        if role == Qt.ItemDataRole.DisplayRole:
+            count = self.counts[tag]
+            return self.names[tag] if count is None else f"{self.names[tag]} ({count})"
+        if role == Qt.ItemDataRole.CheckStateRole:
+            return Qt.CheckState.Checked if tag in self.checked else Qt.CheckState.Unchecked
+        return None
+
+    def toggle(self, row):
+        tag = int(self.matches[row - 1])
+        if tag in self.checked:
+            self.checked.remove(tag)
+        else:
+            self.checked.add(tag)
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def selected_items(self):
+        # Most used first, the checked tags stay selected while filtered out
+        return [self.names[tag] for tag in sorted(self.checked)]
 
 
 class MultiSelectComboBoxWithSearch(QComboBox):
@@ -16,17 +119,12 @@ class MultiSelectComboBoxWithSearch(QComboBox):
 
         self.placeholderText = "Select tags"
 
-        self.model().dataChanged.connect(self.update_text)
-
         self.search_line_edit = QLineEdit(self)
         self.search_line_edit.setPlaceholderText("Search...")
         self.search_line_edit.textChanged.connect(self.filter_items)
         self.search_line_edit.setVisible(False)
-        self.setModel(QStandardItemModel(self))
-        dummy_item = QStandardItem()
-        dummy_item.setText(self.placeholderText)
-        dummy_item.setFlags(Qt.ItemFlag.NoItemFlags)
-        self.model().appendRow(dummy_item)
+        self.setModel(TagListModel(self.placeholderText, self))
+        self.view().verticalScrollBar().valueChanged.connect(self.load_more)
 
     def showPopup(self):
         self.search_line_edit.setVisible(True)
@@ -49,37 +147,28 @@ class MultiSelectComboBoxWithSearch(QComboBox):
             return True
         if obj == self.view().viewport() and event.type() == QEvent.Type.MouseButtonRelease:
             index = self.view().indexAt(event.position().toPoint())
-            item = self.model().itemFromIndex(index)
-            if item and index.row() != 0:
-                item.setCheckState(
-                    Qt.CheckState.Unchecked if item.checkState() == Qt.CheckState.Checked else Qt.CheckState.Checked)
+            if index.isValid() and index.row() != 0:
+                self.model().toggle(index.row())
                 self.update_text()
                 self.selected_items_changed.emit(self.get_selected_items())
                 return True
         return False
 
-    def addItem(self, text):
-        item = QStandardItem()
-        item.setText(text)
-        item.setFlags(Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsUserCheckable)
-        item.setData(Qt.CheckState.Unchecked, Qt.ItemDataRole.CheckStateRole)
-        self.model().appendRow(item)
+    def set_tags(self, names, counts=None):
+        self.model().set_tags(names, counts if counts is not None else [None] * len(names))
+        self.model().filter(self.search_line_edit.text())
+        self.update_text()
 
-    def addItems(self, texts):
-        for text in texts:
-            self.addItem(text)
+    def load_more(self, value):
+        if value >= self.view().verticalScrollBar().maximum():
+            self.model().fetch_more()
 
     def update_text(self):
-        selected_items = [self.model().item(i).text() for i in range(1, self.model().rowCount())
-                          if self.model().item(i).checkState() == Qt.CheckState.Checked]
+        selected_items = self.get_selected_items()
         self.lineEdit().setText(", ".join(selected_items) if selected_items else self.placeholderText)
 
     def filter_items(self, text):
-        for row in range(1, self.model().rowCount()):
-            item = self.model().item(row)
-            should_hide = text.lower() not in item.text().lower()
-            self.view().setRowHidden(row, should_hide)
+        self.model().filter(text)
 
     def get_selected_items(self):
-        return [self.model().item(i).text() for i in range(1, self.model().rowCount())
-                if self.model().item(i).checkState() == Qt.CheckState.Checked]
+        return self.model().selected_items()
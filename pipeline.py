@@ -0,0 +1,117 @@
+import queue
+import threading
+import time
+
+# Sent once per worker to shut a stage down, the last worker to stop forwards it to the next stage
+STOP = object()
+# How long a batching stage waits for more items before running a partial batch
+BATCH_WAIT = 0.05
+
+
+class Stage:
+    def __init__(self, name, function, workers=1, queueSize=32, batchSize=1):
+        # function gets one item, or a list of up to batchSize items when batchSize > 1. It returns
+        # what is passed to the next stage: an item (None drops it) or a list of items.
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batchSize = batchSize
+        self.input = queue.Queue(maxsize=queueSize)
+        self.next = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.running = 0
+        # Time spent in function and the number of items it handled, for latency reporting
+        self.busyTime = 0.0
+        self.itemsDone = 0
+
+    def start(self, onError):
+        self.onError = onError
+        self.running = self.workers
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f"{self.name}-{index}", daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def take(self):
+        # Blocks for the first item, then collects whatever else arrives within BATCH_WAIT
+        item = self.input.get()
+        if item is STOP:
+            return None, True
+        if self.batchSize == 1:
+            return item, False
+
+        items = [item]
+        while len(items) < self.batchSize:
+            try:
+                item = self.input.get(timeout=BATCH_WAIT)
+            except queue.Empty:
+                break
+            if item is STOP:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def work(self):
+        while True:
+            work, stop = self.take()
+            if work is not None:
+                startTime = time.perf_counter()
+                try:
+                    result = self.function(work)
+                except Exception as e:
+                    self.onError(work if isinstance(work, list) else [work], e)
+                    result = None
+                with self.lock:
+                    self.busyTime += time.perf_counter() - startTime
+                    self.itemsDone += len(work) if isinstance(work, list) else 1
+                self.forward(result)
+            if stop:
+                break
+
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last and self.next is not None:
+            self.next.close()
+
+    def forward(self, result):
+        if result is None or self.next is None:
+            return
+        if isinstance(result, list):
+            for item in result:
+                self.next.input.put(item)
+        else:
+            # Blocks while the next stage is full, which is what keeps memory bounded
+            self.next.input.put(result)
+
+    def close(self):
+        for _ in range(self.workers):
+            self.input.put(STOP)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+class Pipeline:
+    def __init__(self, stages, onError):
+        self.stages = stages
+        self.onError = onError
+        for stage, nextStage in zip(stages, stages[1:]):
+            stage.next = nextStage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start(self.onError)
+
+    def put(self, item):
+        self.stages[0].input.put(item)
+
+    def close(self):
+        # Lets the items already queued finish, then stops every stage in order
+        self.stages[0].close()
+
+    def join(self):
+        for stage in self.stages:
+            stage.join()
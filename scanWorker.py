@@ -0,0 +1,198 @@
+import hashlib
+import os
+import time
+from PIL import Image
+from exifOperations import update_metadata_batch
+from getTags import get_predictor, getTagNames, load_image, load_predictor
+from getText import ocr_with_paddle, ocrPool
+from thumbnailCache import image_orientation, make_thumbnail
+
+# Tags scoring above this are kept
+SCORE_THRESHOLD = 0.5
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Batch buffer of the current worker process
+workerBuffer = None
+
+
+class ScanItem:
+    def __init__(self, filePath, directory, file, rowId):
+        self.filePath = filePath
+        self.directory = directory
+        self.file = file
+        self.rowId = rowId
+        self.image = None
+        self.thumbnail = None
+        self.tagIds = None
+        self.scores = None
+        self.tagNames = []
+        self.tags = ""
+        self.text = ""
+        self.sha = None
+        self.signature = None
+        self.ctime = None
+        self.width = None
+        self.height = None
+        # Tags and text copied from an indexed image with the same content, no inference needed
+        self.reused = False
+        # Row of a missing file with the same content, which this file takes over
+        self.movedFrom = None
+        # Hash of the file when it was found, before its metadata was rewritten
+        self.contentSha = None
+        # Later files of the scan with the same content, they reuse this item's results
+        self.copies = []
+        # Stored hash of an indexed file whose stat changed, it's only scanned again when the content
+        # differs. Whether the row lacks its dimensions or is marked deleted, for refreshing it otherwise.
+        self.storedSha = None
+        self.sizeMissing = False
+        self.storedDeleted = False
+        self.error = None
+
+
+def calculate_sha256(filename):
+    sha256Hash = hashlib.sha256()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    with open(filename, "rb", buffering=0) as file:
+        while size := file.readinto(buffer):
+            sha256Hash.update(view[:size])
+    return sha256Hash.hexdigest()
+
+
+def stat_signature(stat):
+    # Cheap change check, compared against the values stored in the database
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def file_signature(filePath):
+    return stat_signature(os.stat(filePath))
+
+
+def image_size(filePath):
+    # Only reads the header
+    with Image.open(filePath) as image:
+        return image.size
+
+
+def hash_file(filePath):
+    # Stat first so a write during hashing shows up as a change on the next scan
+    stat = os.stat(filePath)
+    return calculate_sha256(filePath), stat
+
+
+def decode_item(item):
+    # Decode near the model resolution, raises for files that can't be read or exceed the pixel budget.
+    # The thumbnail is made from the same decode.
+    predictor = get_predictor()
+    with load_image(item.filePath, predictor.model_target_size) as image:
+        item.width, item.height = image.info["full_size"]
+        item.image = predictor.resize_image(image)
+        item.thumbnail = make_thumbnail(item.image, image_orientation(image))
+    return item
+
+
+def tag_items(items, batchBuffer):
+    predictor = get_predictor()
+    for item, slot in zip(items, batchBuffer):
+        predictor.prepare_image(item.image, slot)
+        item.image = None
+
+    # Get tags for the whole batch in one inference call
+    batchTags = predictor.predict_tensor(batchBuffer[:len(items)], SCORE_THRESHOLD)
+    for item, (tagIds, scores) in zip(items, batchTags):
+        item.tagIds = tagIds
+        item.scores = scores
+    return items
+
+
+def read_item_text(item):
+    item.text = ocr_with_paddle(item.filePath)
+    return item
+
+
+def update_item_files(items, delete, write):
+    # Delete and write metadata in one rewrite per file, the files of a batch share exiftool round
+    # trips. Files are hashed after it, a file hashed before the scan that isn't rewritten keeps that
+    # hash. Items that fail get their error set.
+    for item in items:
+        if not item.reused:
+            item.tagNames = getTagNames(item.tagIds)
+            finalTags = ""
+            for label in item.tagNames:
+                finalTags += label + ";"
+            item.tags = finalTags
+
+    if not delete and not write:
+        updated = [item for item in items if item.sha is None]
+        errors = [None] * len(updated)
+    else:
+        updated = items
+        errors = update_metadata_batch([
+            (item.filePath, delete, item.tags if write else None, item.text if write else None) for item in items
+        ])
+    for item, error in zip(updated, errors):
+        if error is None:
+            try:
+                item.sha, stat = hash_file(item.filePath)
+                item.signature = stat_signature(stat)
+                item.ctime = stat.st_ctime_ns
+            except OSError as e:
+                error = e
+        if error is not None:
+            item.error = str(error)
+    return items
+
+
+def init_worker(intraOpThreads, ocrThreads, batchSize):
+    # Runs once in every worker process: load the models with a share of the cores
+    global workerBuffer
+    predictor = load_predictor(intraOpThreads)
+    workerBuffer = predictor.allocate_batch(batchSize)
+    ocrPool.cpuThreads = ocrThreads
+    ocrPool.warm_up()
+
+
+def process_shard(items, delete, write):
+    # Runs a shard of files through every step except the database write, which stays with the parent.
+    # Returns the items and the seconds spent per step.
+    timings = {"decode": 0.0, "tag": 0.0, "ocr": 0.0, "metadata": 0.0}
+
+    startTime = time.perf_counter()
+    decoded = []
+    for item in items:
+        try:
+            decoded.append(decode_item(item))
+        except Exception as e:
+            item.error = str(e)
+    timings["decode"] += time.perf_counter() - startTime
+
+    for start in range(0, len(decoded), len(workerBuffer)):
+        batch = decoded[start:start + len(workerBuffer)]
+        startTime = time.perf_counter()
+        try:
+            tag_items(batch, workerBuffer)
+        except Exception as e:
+            for item in batch:
+                item.image = None
+                item.error = str(e)
+            continue
+        timings["tag"] += time.perf_counter() - startTime
+
+        for item in batch:
+            try:
+                startTime = time.perf_counter()
+                read_item_text(item)
+                timings["ocr"] += time.perf_counter() - startTime
+            except Exception as e:
+                item.error = str(e)
+
+        batch = [item for item in batch if item.error is None]
+        startTime = time.perf_counter()
+        try:
+            update_item_files(batch, delete, write)
+        except Exception as e:
+            for item in batch:
+                item.error = str(e)
+        timings["metadata"] += time.perf_counter() - startTime
+    return items, timings
@@ -0,0 +1,77 @@
+import sqlite3
+import threading
+from PyQt6.QtCore import QThread, pyqtSignal
+from database import connect
+
+
+class SearchWorker(QThread):
+    # Runs searches off the GUI thread. Only the newest request is kept: a new one interrupts the
+    # query in flight, and every result carries the generation it was started for so stale results
+    # can be dropped.
+
+    # Emits the generation, the visible ids and whether they are ranked by text relevance
+    resultsReady = pyqtSignal(int, object, bool)
+
+    def __init__(self, filterIndex):
+        super().__init__()
+        self.filterIndex = filterIndex
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.pending = None
+        self.running = True
+        self.conn = None
+
+    def search(self, tags, favorites, textQuery):
+        # Called from the GUI thread, returns the generation the results will be emitted with
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, tags, favorites, textQuery)
+            if self.conn is not None:
+                self.conn.interrupt()
+            self.condition.notify()
+            return self.generation
+
+    def is_latest(self, generation):
+        with self.condition:
+            return generation == self.generation
+
+    def run(self):
+        conn = connect()
+        with self.condition:
+            self.conn = conn
+        try:
+            while True:
+                with self.condition:
+                    while self.running and self.pending is None:
+                        self.condition.wait()
+                    if not self.running:
+                        break
+                    generation, tags, favorites, textQuery = self.pending
+                    self.pending = None
+
+                textIds = None
+                if textQuery:
+                    try:
+                        cursor = conn.execute("SELECT rowid FROM images_text WHERE images_text MATCH ? ORDER BY rank", (textQuery,))
+                        textIds = [row[0] for row in cursor.fetchall()]
+                    except sqlite3.OperationalError:
+                        # Interrupted by a newer search, or a query FTS5 can't parse
+                        if not self.is_latest(generation):
+                            continue
+                        textIds = []
+
+                ids = self.filterIndex.filter(tags, favorites, textIds)
+                if self.is_latest(generation):
+                    self.resultsReady.emit(generation, ids, textIds is not None)
+        finally:
+            with self.condition:
+                self.conn = None
+            conn.close()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            if self.conn is not None:
+                self.conn.interrupt()
+            self.condition.notify()
+        self.wait()
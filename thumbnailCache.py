@@ -0,0 +1,129 @@
+import io
+import mmap
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from PIL import Image
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+# Thumbnails of every scanned image packed into one file, the thumbnails table holds the offset and
+# length of each one by shaValue. Entries are only ever appended.
+THUMBNAIL_PATH = "thumbnails.bin"
+THUMBNAIL_SIZE = 250
+JPEG_QUALITY = 85
+
+# EXIF orientation -> the transpose that shows the image upright
+ORIENTATION_TAG = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Scans in the same process (e.g. the folder watcher) append to the same file
+appendLock = threading.Lock()
+# Other processes (the command line indexer, a second window) are kept out by locking this file,
+# not the pack itself, whose bytes are memory mapped by the readers
+LOCK_SUFFIX = ".lock"
+
+
+def image_orientation(image):
+    return image.getexif().get(ORIENTATION_TAG, 1)
+
+
+def make_thumbnail(image, orientation=1):
+    # Encodes image, already decoded at a reduced size, as a thumbnail. JPEG unless it has alpha.
+    thumbnail = image.copy()
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BICUBIC)
+    if orientation in ORIENTATION_TRANSPOSE:
+        thumbnail = thumbnail.transpose(ORIENTATION_TRANSPOSE[orientation])
+
+    buffer = io.BytesIO()
+    if thumbnail.mode == "RGBA":
+        thumbnail.save(buffer, "PNG", optimize=False)
+    else:
+        thumbnail.convert("RGB").save(buffer, "JPEG", quality=JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+@contextmanager
+def locked(file):
+    # Exclusive lock on file across processes, blocks until it's free
+    if sys.platform == "win32":
+        file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                # LK_LOCK gives up after about 10 seconds
+                continue
+        try:
+            yield
+        finally:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class ThumbnailWriter:
+    def __init__(self, path=THUMBNAIL_PATH):
+        self.file = open(path, "ab")
+        self.lockFile = open(path + LOCK_SUFFIX, "ab")
+
+    def append(self, data):
+        # Returns the offset data was written at. The end of the file is looked up under the lock,
+        # so an append by another process can't land between the seek and the write.
+        with appendLock, locked(self.lockFile):
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(data)
+            self.file.flush()
+        return offset
+
+    def close(self):
+        self.file.close()
+        self.lockFile.close()
+
+
+class ThumbnailReader:
+    # Reads thumbnails straight from a memory map of the pack, remapped when a scan has grown it
+    def __init__(self, path=THUMBNAIL_PATH):
+        self.path = path
+        self.map = None
+        self.lock = threading.Lock()
+
+    def read(self, offset, length):
+        with self.lock:
+            if self.map is None or offset + length > len(self.map):
+                self.remap()
+            if self.map is None or offset + length > len(self.map):
+                return None
+            return self.map[offset:offset + length]
+
+    def remap(self):
+        self.close()
+        try:
+            with open(self.path, "rb") as file:
+                if os.fstat(file.fileno()).st_size:
+                    self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            self.map = None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
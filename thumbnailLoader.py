@@ -0,0 +1,89 @@
+import threading
+from PyQt6.QtCore import Qt, QObject, QRunnable, QSize, QThreadPool, pyqtSignal
+from PyQt6.QtGui import QImage, QImageReader
+from thumbnailCache import THUMBNAIL_SIZE, ThumbnailReader
+
+# Threads decoding thumbnails, 0 uses one per core
+LOADER_THREADS = 0
+# Pool priority of prefetch requests, below every request for a visible thumbnail
+PREFETCH_PRIORITY = 0
+
+
+class ThumbnailTask(QRunnable):
+    def __init__(self, loader, key, path, span):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.loader = loader
+        self.key = key
+        self.path = path
+        self.span = span
+
+    def run(self):
+        image, resolution = self.loader.load(self.path, self.span)
+        self.loader.finish(self, image, resolution)
+
+
+class ThumbnailLoader(QObject):
+    # Loads thumbnails on a thread pool, from the thumbnail pack or by a scaled decode of the
+    # original. The most recently requested thumbnails run first, queued ones can be cancelled.
+    # Emits the key, the path, the thumbnail and, when the original was decoded, its resolution on
+    # the GUI thread.
+    loaded = pyqtSignal(object, str, QImage, QSize)
+
+    def __init__(self, threads=LOADER_THREADS, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        if threads:
+            self.pool.setMaxThreadCount(threads)
+        self.reader = ThumbnailReader()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.priority = 0
+
+    def request(self, key, path, span, prefetch=False):
+        # Returns at once, loaded is emitted when the thumbnail is ready. Does nothing if key is
+        # already pending.
+        with self.lock:
+            if key in self.pending:
+                return
+            task = self.pending[key] = ThumbnailTask(self, key, path, span)
+            if prefetch:
+                priority = PREFETCH_PRIORITY
+            else:
+                self.priority += 1
+                priority = self.priority
+        self.pool.start(task, priority)
+
+    def cancel_except(self, keys):
+        # Drops the queued requests not in keys, e.g. for items scrolled out of view
+        with self.lock:
+            cancelled = [task for key, task in self.pending.items() if key not in keys]
+        for task in cancelled:
+            if self.pool.tryTake(task):
+                with self.lock:
+                    self.pending.pop(task.key, None)
+
+    def load(self, path, span):
+        # Runs on a pool thread. QImage is safe to use off the GUI thread, QPixmap is not.
+        data = self.reader.read(*span) if span else None
+        image = QImage()
+        if data is not None and image.loadFromData(data):
+            return image, QSize()
+
+        # Not in the thumbnail pack, let the decoder scale while decoding
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        resolution = reader.size()
+        if resolution.isValid():
+            reader.setScaledSize(resolution.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.AspectRatioMode.KeepAspectRatio))
+        return reader.read(), resolution
+
+    def finish(self, task, image, resolution):
+        with self.lock:
+            self.pending.pop(task.key, None)
+        self.loaded.emit(task.key, task.path, image, resolution)
+
+    def stop(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+        self.reader.close()
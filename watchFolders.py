@@ -1,73 +1,249 @@
 import os
+import queue
 import threading
+import time
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from scan import start_scanner
+from watchdog.events import (
+    FileSystemEventHandler, EVENT_TYPE_CLOSED, EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED
+)
+from database import BatchedWriter, connect, create_tables, mark_deleted, mark_directory_deleted, move_directory, move_image
+from indexer import Indexer, top_directories
 
 imageExtensions = {".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp"}
+# Changed files are indexed once this many are pending, or this many seconds after the first one.
+# The delay also lets a file being copied settle before it's read.
+INGEST_BATCH_SIZE = 256
+INGEST_LATENCY = 2.0
+
+# Other events, e.g. a file being opened, don't change it
+SCAN_EVENTS = {EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_CLOSED}
+
 observers = []
-pending_scans = {}
-scan_lock = threading.Lock()
+ingestion = None
+STOP = object()
 
 
-def scan(file_path, delete, write):
-    start_scanner(file_path, delete, write)
+def is_image(path):
+    return os.path.splitext(path)[1].lower() in imageExtensions
 
 
-class MyHandler(FileSystemEventHandler):
-    def __init__(self, delete, write):
-        super().__init__()
+def is_below(path, directory):
+    return path == directory or path.startswith(os.path.join(directory, ""))
+
+
+def batch_directory(files):
+    # Directory a batch is reported under, files on different drives have no common path
+    directories = sorted({directory for directory, _ in files})
+    try:
+        return os.path.commonpath(directories)
+    except ValueError:
+        return directories[0]
+
+
+class IngestionWorker(threading.Thread):
+    # One resident thread indexing everything the observers report, subfolders included. Events wait
+    # in a queue, repeated events for a file are merged, and each batch goes through a single Indexer
+    # run so tagging and OCR see whole batches instead of one file at a time. Moves and deletes only
+    # update the database.
+    def __init__(self, delete, write, batchSize=INGEST_BATCH_SIZE, maxLatency=INGEST_LATENCY, listener=None):
+        super().__init__(daemon=True)
         self.delete = delete
         self.write = write
+        self.batchSize = batchSize
+        self.maxLatency = maxLatency
+        self.listener = listener
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+        self.running = True
+        self.indexer = None
+        # (directory, file name) to scan in order of the first event, a dict so repeated events are merged
+        self.pending = {}
+        self.batchStart = None
+        self.writer = None
+
+    # Called from the observer threads
+    def add(self, directory, file):
+        self.events.put(("scan", (directory, file)))
+
+    def move(self, old, new):
+        self.events.put(("move", old, new))
+
+    def move_directory(self, old, new):
+        self.events.put(("moveDirectory", old, new))
+
+    def remove(self, directory, file):
+        self.events.put(("remove", (directory, file)))
+
+    def remove_directory(self, path):
+        self.events.put(("removeDirectory", path))
+
+    def run(self):
+        conn = connect()
+        create_tables(conn)
+        self.writer = BatchedWriter(conn)
+        try:
+            while True:
+                timeout = None if self.batchStart is None else max(0.0, self.batchStart + self.maxLatency - time.monotonic())
+                try:
+                    event = self.events.get(timeout=timeout)
+                except queue.Empty:
+                    event = None
+                if event is STOP:
+                    break
+                if event is not None:
+                    self.handle(*event)
+                if self.events.empty():
+                    # Moves are committed in groups, but never left open while idle
+                    self.commit()
+
+                if self.pending and (len(self.pending) >= self.batchSize or time.monotonic() >= self.batchStart + self.maxLatency):
+                    # The Indexer writes on its own connection
+                    self.commit()
+                    self.ingest(list(self.pending))
+                    self.pending = {}
+                    self.batchStart = None
+        finally:
+            self.writer.commit()
+            conn.close()
+
+    def commit(self):
+        try:
+            self.writer.commit()
+        except Exception as e:
+            print(f"Error committing changes: {e}")
 
-    def on_any_event(self, event):
-        if event.is_directory:
-            return
-
-        file_extension = os.path.splitext(event.src_path)[1].lower()
-        if file_extension not in imageExtensions:
+    def handle(self, action, *args):
+        # An event that fails is reported and skipped, the thread keeps serving the others
+        try:
+            self.apply(action, *args)
+        except Exception as e:
+            path = os.path.join(*args[0]) if isinstance(args[0], tuple) else args[0]
+            print(f"Error {path}: {e}")
+
+    def apply(self, action, *args):
+        if action == "scan":
+            self.queue_scan(*args)
+        elif action == "move":
+            old, new = args
+            moved = move_image(self.writer, *old, *new)
+            # Never scanned, or changed before it was moved: scan it under the new name
+            if old in self.pending or not moved:
+                self.pending.pop(old, None)
+                self.queue_scan(new)
+        elif action == "moveDirectory":
+            old, new = args
+            move_directory(self.writer, old, new)
+            for directory, file in list(self.pending):
+                if is_below(directory, old):
+                    del self.pending[(directory, file)]
+                    self.pending[(new + directory[len(old):], file)] = None
+            print(f"Moved: {old} -> {new}")
+        elif action == "remove":
+            mark_deleted(self.writer, *args[0])
+            self.pending.pop(args[0], None)
+        elif action == "removeDirectory":
+            mark_directory_deleted(self.writer, args[0])
+            for key in [key for key in self.pending if is_below(key[0], args[0])]:
+                del self.pending[key]
+            print(f"Removed: {args[0]}")
+
+    def queue_scan(self, file):
+        self.pending[file] = None
+        if self.batchStart is None:
+            self.batchStart = time.monotonic()
+
+    def ingest(self, files):
+        # Deleted again before the batch ran
+        files = [(directory, file) for directory, file in files if os.path.isfile(os.path.join(directory, file))]
+        if not files:
             return
 
-        with scan_lock:
-            if event.src_path in pending_scans:
-                pending_scans[event.src_path].cancel()
-            timer = threading.Timer(0.5, self.run_scan, [event.src_path])
-            pending_scans[event.src_path] = timer
-            timer.start()
-
-    def run_scan(self, file_path):
+        # One pipeline for the whole batch, whichever subfolders the files are in
+        directory = batch_directory(files)
         try:
-            with scan_lock:
-                pending_scans.pop(file_path, None)
-            scan(file_path, self.delete, self.write)
-            print(f"Detected change: {file_path}")
+            with self.lock:
+                if not self.running:
+                    return
+                self.indexer = Indexer(directory, self.delete, self.write, listener=self.listener, files=files)
+            self.indexer.run()
+            print(f"Detected changes: {len(files)} files in {directory}")
         except Exception as e:
-            print(f"Error {file_path}: {e}")
+            print(f"Error {directory}: {e}")
+        finally:
+            with self.lock:
+                self.indexer = None
+
+    def stop(self):
+        # Files still waiting are left for the next full scan
+        with self.lock:
+            self.running = False
+            if self.indexer is not None:
+                self.indexer.stop()
+        self.events.put(STOP)
+        self.join()
 
 
-def start_watching(directories, delete, write):
-    global observers
+class MyHandler(FileSystemEventHandler):
+    def __init__(self, folder, ingestion):
+        super().__init__()
+        self.folder = os.path.normpath(folder)
+        self.ingestion = ingestion
 
-    for folder in directories:
-        event_handler = MyHandler(delete, write)
+    def on_any_event(self, event):
+        if event.event_type == EVENT_TYPE_MOVED:
+            self.on_move(event)
+        elif event.event_type == EVENT_TYPE_DELETED:
+            if event.is_directory:
+                self.ingestion.remove_directory(self.local_path(event.src_path))
+            elif is_image(event.src_path):
+                self.ingestion.remove(*os.path.split(self.local_path(event.src_path)))
+        elif event.event_type in SCAN_EVENTS and not event.is_directory and is_image(event.src_path):
+            self.ingestion.add(*os.path.split(self.local_path(event.src_path)))
+
+    def on_move(self, event):
+        old = self.local_path(event.src_path)
+        new = self.local_path(event.dest_path)
+        if event.is_directory:
+            self.ingestion.move_directory(old, new)
+        elif is_image(old) and is_image(new):
+            self.ingestion.move(os.path.split(old), os.path.split(new))
+        elif is_image(old):
+            self.ingestion.remove(*os.path.split(old))
+        elif is_image(new):
+            self.ingestion.add(*os.path.split(new))
+
+    def local_path(self, path):
+        # The path spelled the way a scan stores it: normalized, starting with the folder as added
+        return os.path.normpath(os.path.join(self.folder, os.path.relpath(path, self.folder)))
+
+
+def start_watching(directories, delete, write, batchSize=INGEST_BATCH_SIZE, maxLatency=INGEST_LATENCY):
+    global observers, ingestion
+
+    if ingestion is None:
+        ingestion = IngestionWorker(delete, write, batchSize, maxLatency)
+        ingestion.start()
+
+    # A folder below another one is already watched with it
+    for folder in top_directories(directories):
+        event_handler = MyHandler(folder, ingestion)
         observer = Observer()
-        observer.schedule(event_handler, folder, recursive=False)
+        observer.schedule(event_handler, folder, recursive=True)
         observers.append(observer)
         observer.start()
         print(f"Watching: {folder}")
 
 
 def stop_watching():
-    global observers
+    global observers, ingestion
     print("Stopping observers...")
 
-    with scan_lock:
-        for timer in pending_scans.values():
-            timer.cancel()
-        pending_scans.clear()
-
     for observer in observers:
         observer.stop()
     for observer in observers:
         observer.join()
     observers = []
+
+    if ingestion is not None:
+        ingestion.stop()
+        ingestion = None